@@ -0,0 +1,359 @@
+"""
+A small local captioning service with dynamic batching.
+
+Captioning a single image at a time wastes almost all of the width of the
+matrix multiplies inside CaptioningRNN.sample. The CaptionServer accepts
+single feature vectors over HTTP on localhost, collects the requests that
+arrive within a short latency budget into one micro-batch, and captions the
+whole batch with a single call to model.sample.
+
+Example usage might look something like this:
+
+server = CaptionServer(model, max_batch_size=64, max_delay=0.01)
+server.start()
+client = CaptionClient(port=server.port)
+print client.caption(data['val_features'][0])['text']
+print client.stats()
+server.shutdown()
+"""
+
+import json, threading, time, urllib2
+import BaseHTTPServer, SocketServer
+from collections import deque
+from Queue import Queue, Empty
+
+import numpy as np
+
+from cs231n.coco_utils import decode_captions
+
+
+class _CaptionRequest(object):
+  """
+  A single pending request; the batching thread fills in the result and sets
+  the event.
+  """
+  def __init__(self, features):
+    self.features = features
+    self.arrival = time.time()
+    self.done = threading.Event()
+    self.caption = None
+    self.error = None
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class _CaptionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """
+  HTTP front end of the CaptionServer:
+
+  - POST /caption with a JSON body {"features": [...]} returns
+    {"caption": [...word indices...], "text": "..."}.
+  - GET /stats returns the output of CaptionServer.stats().
+  """
+
+  def do_POST(self):
+    if self.path != '/caption':
+      self._reply(404, {'error': 'Unknown path "%s"' % self.path})
+      return
+    try:
+      length = int(self.headers.getheader('content-length', 0))
+      body = json.loads(self.rfile.read(length))
+      features = np.asarray(body['features'], dtype=float)
+      self.server.caption_server.check_features(features)
+    except (ValueError, KeyError, TypeError) as e:
+      self._reply(400, {'error': str(e)})
+      return
+    # Failures while captioning or decoding are server errors; report them
+    # to the client rather than dropping the connection.
+    try:
+      caption = self.server.caption_server.submit(features)
+      text = decode_captions(caption, self.server.caption_server.idx_to_word)
+    except Exception as e:
+      self._reply(500, {'error': '%s: %s' % (type(e).__name__, e)})
+      return
+    self._reply(200, {'caption': caption.tolist(), 'text': text})
+
+  def do_GET(self):
+    if self.path != '/stats':
+      self._reply(404, {'error': 'Unknown path "%s"' % self.path})
+      return
+    self._reply(200, self.server.caption_server.stats())
+
+  def _reply(self, code, obj):
+    body = json.dumps(obj)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # Keep the console quiet; use stats() to see what the server is doing.
+    pass
+
+
+class CaptionServer(object):
+  """
+  A CaptionServer exposes model.sample as a long-running local HTTP service
+  with dynamic batching. A single background thread takes requests from a
+  queue: once the first request of a batch arrives it keeps collecting
+  requests for at most max_delay seconds or until max_batch_size requests are
+  waiting, then runs one batched decode and hands the captions back.
+
+  The server keeps track of the current queue depth, a histogram of batch
+  sizes and the end-to-end latency of recent requests; see stats().
+  """
+
+  def __init__(self, model, **kwargs):
+    """
+    Construct a new CaptionServer.
+
+    Required arguments:
+    - model: A model with a sample(features, max_length) method and an
+      idx_to_word mapping, such as CaptioningRNN.
+
+    Optional arguments:
+    - host: Host to listen on. Default is '127.0.0.1'.
+    - port: Port to listen on; 0 picks a free port. Default is 0.
+    - max_batch_size: Maximum number of requests decoded together.
+    - max_delay: Maximum time in seconds that the first request of a batch
+      waits for more requests to arrive.
+    - max_length: Maximum caption length passed to model.sample.
+    - num_latencies: Number of recent latencies kept for the percentiles.
+    """
+    self.model = model
+    self.idx_to_word = model.idx_to_word
+    # Feature dimension expected by the model, if we can tell
+    self.input_dim = None
+    if 'W_proj' in getattr(model, 'params', {}):
+      self.input_dim = model.params['W_proj'].shape[0]
+
+    self.host = kwargs.pop('host', '127.0.0.1')
+    port = kwargs.pop('port', 0)
+    self.max_batch_size = kwargs.pop('max_batch_size', 64)
+    self.max_delay = kwargs.pop('max_delay', 0.01)
+    self.max_length = kwargs.pop('max_length', 30)
+    num_latencies = kwargs.pop('num_latencies', 10000)
+
+    # Throw an error if there are extra keyword arguments
+    if len(kwargs) > 0:
+      extra = ', '.join('"%s"' % k for k in kwargs.keys())
+      raise ValueError('Unrecognized arguments %s' % extra)
+
+    self._queue = Queue()
+    self._lock = threading.Lock()
+    self._latencies = deque(maxlen=num_latencies)
+    self._batch_sizes = {}
+    self._num_requests = 0
+    self._running = False
+
+    self._httpd = _ThreadingHTTPServer((self.host, port), _CaptionHandler)
+    self._httpd.caption_server = self
+    self.port = self._httpd.server_address[1]
+    self._threads = []
+
+
+  def start(self):
+    """
+    Start the batching thread and the HTTP server in background threads.
+    """
+    self._running = True
+    for target in (self._batch_loop, self._httpd.serve_forever):
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+
+  def shutdown(self):
+    """
+    Stop the HTTP server and the batching thread.
+    """
+    self._running = False
+    self._httpd.shutdown()
+    self._httpd.server_close()
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+    # Fail the requests that never made it into a batch, so that their
+    # callers do not wait forever.
+    while True:
+      try:
+        request = self._queue.get_nowait()
+      except Empty:
+        break
+      request.error = RuntimeError('CaptionServer was shut down')
+      request.done.set()
+
+
+  def check_features(self, features):
+    """
+    Raise a ValueError unless features is a single feature vector of the size
+    the model expects.
+    """
+    if features.ndim != 1:
+      raise ValueError('Expected a single feature vector, got shape %s'
+                       % (features.shape,))
+    if self.input_dim is not None and features.shape[0] != self.input_dim:
+      raise ValueError('Expected %d features, got %d'
+                       % (self.input_dim, features.shape[0]))
+
+
+  def submit(self, features):
+    """
+    Caption a single image from the current thread, going through the same
+    batching queue as HTTP requests.
+
+    Inputs:
+    - features: Array of image features of shape (D,)
+
+    Returns:
+    - caption: Integer array of shape (max_length,) as produced by
+      model.sample.
+    """
+    features = np.asarray(features)
+    self.check_features(features)
+    if not self._running:
+      raise RuntimeError('CaptionServer is not running')
+    request = _CaptionRequest(features)
+    self._queue.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.caption
+
+
+  def stats(self):
+    """
+    Return a dictionary of serving statistics:
+    - queue_depth: Number of requests waiting for a batch right now
+    - num_requests: Number of requests captioned successfully so far
+    - batch_sizes: Dictionary mapping batch size to the number of batches of
+      that size
+    - latency_p50, latency_p99: Percentiles in seconds of the end-to-end
+      latency of recent requests, from arrival to caption
+    """
+    with self._lock:
+      latencies = np.asarray(self._latencies)
+      stats = {
+        'queue_depth': self._queue.qsize(),
+        'num_requests': self._num_requests,
+        'batch_sizes': dict(self._batch_sizes),
+      }
+    if latencies.shape[0] > 0:
+      stats['latency_p50'] = float(np.percentile(latencies, 50))
+      stats['latency_p99'] = float(np.percentile(latencies, 99))
+    else:
+      stats['latency_p50'] = stats['latency_p99'] = None
+    return stats
+
+
+  def _next_batch(self):
+    """
+    Wait for a request, then collect more requests until the batch is full
+    or the latency budget of the first request has been used up.
+    """
+    try:
+      batch = [self._queue.get(timeout=0.1)]
+    except Empty:
+      return []
+    deadline = batch[0].arrival + self.max_delay
+    while len(batch) < self.max_batch_size:
+      remaining = deadline - time.time()
+      try:
+        if remaining > 0:
+          batch.append(self._queue.get(timeout=remaining))
+        else:
+          batch.append(self._queue.get_nowait())
+      except Empty:
+        break
+    return batch
+
+
+  def _caption(self, batch):
+    """
+    Caption a batch of requests with a single call to model.sample.
+    """
+    features = np.vstack([r.features for r in batch])
+    captions = self.model.sample(features, max_length=self.max_length)
+    for request, caption in zip(batch, captions):
+      request.caption = caption
+
+
+  def _batch_loop(self):
+    """
+    Body of the batching thread: run one batched decode per batch.
+    """
+    while self._running:
+      batch = self._next_batch()
+      if len(batch) == 0:
+        continue
+      # Groups of requests that were captioned successfully
+      captioned = []
+      try:
+        self._caption(batch)
+        captioned.append(batch)
+      except Exception as e:
+        if len(batch) == 1:
+          batch[0].error = e
+        else:
+          # Retry the requests one at a time, so that a single bad request
+          # does not fail the others of its batch.
+          for request in batch:
+            try:
+              self._caption([request])
+              captioned.append([request])
+            except Exception as e:
+              request.error = e
+
+      # Failed requests are left out of the statistics
+      finished = time.time()
+      with self._lock:
+        for group in captioned:
+          size = len(group)
+          self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+          self._num_requests += size
+          self._latencies.extend(finished - r.arrival for r in group)
+      for request in batch:
+        request.done.set()
+
+
+class CaptionClient(object):
+  """
+  A minimal client for a CaptionServer running on this machine. It stands in
+  for the real callers of the service, and is handy for load testing: run
+  caption() from several threads to see how requests get batched.
+  """
+
+  def __init__(self, host='127.0.0.1', port=8000, timeout=60):
+    self.url = 'http://%s:%d' % (host, port)
+    self.timeout = timeout
+
+
+  def caption(self, features):
+    """
+    Caption a single image.
+
+    Inputs:
+    - features: Array of image features of shape (D,)
+
+    Returns a dictionary with keys:
+    - caption: List of word indices
+    - text: The decoded caption
+    """
+    body = json.dumps({'features': np.asarray(features).tolist()})
+    request = urllib2.Request(self.url + '/caption', body,
+                              {'Content-Type': 'application/json'})
+    return json.loads(urllib2.urlopen(request, timeout=self.timeout).read())
+
+
+  def stats(self):
+    """
+    Return the serving statistics of the server; see CaptionServer.stats().
+    """
+    f = urllib2.urlopen(self.url + '/stats', timeout=self.timeout)
+    return json.loads(f.read())
@@ -1,7 +1,10 @@
+import multiprocessing, traceback
 import numpy as np
 
 from cs231n import optim
-from cs231n.coco_utils import sample_coco_minibatch
+from cs231n.coco_utils import sample_coco_minibatch, EpochSampler
+from cs231n.coco_utils import MinibatchPrefetcher, corpus_bleu
+from cs231n.rnn_layers import scatter_sparse_rows
 
 
 class CaptioningSolver(object):
@@ -11,8 +14,8 @@ class CaptioningSolver(object):
   descent using different update rules defined in optim.py.
 
   The solver accepts both training and validataion data and labels so it can
-  periodically check classification accuracy on both training and validation
-  data to watch out for overfitting.
+  periodically check the BLEU score of sampled captions on both training and
+  validation data to watch out for overfitting.
 
   To train a model, you will first construct a CaptioningSolver instance,
   passing the model, dataset, and various options (learning rate, batch size,
@@ -24,7 +27,8 @@ class CaptioningSolver(object):
   In addition, the instance variable solver.loss_history will contain a list
   of all losses encountered during training and the instance variables
   solver.train_acc_history and solver.val_acc_history will be lists containing
-  the accuracies of the model on the training and validation set at each epoch.
+  the BLEU scores of the model on the training and validation set at each
+  epoch; solver.val_loss_history holds the matching validation losses.
   
   Example usage might look something like this:
   
@@ -59,6 +63,14 @@ class CaptioningSolver(object):
     - loss: Scalar giving the loss
     - grads: Dictionary with the same keys as self.params mapping parameter
       names to gradients of the loss with respect to those parameters.
+
+    For validation, model.loss(features, captions, mode='test') is called to
+    compute the test-time loss; it only needs to run the forward pass, and
+    the gradients it returns are ignored.
+
+  - model.sample(features, max_length) must return an integer array of shape
+    (N, max_length) with a sampled caption for each image; it is used to
+    compute BLEU scores.
   """
 
   def __init__(self, model, data, **kwargs):
@@ -68,6 +80,7 @@ class CaptioningSolver(object):
     Required arguments:
     - model: A model object conforming to the API described above
     - data: A dictionary of training and validation data from load_coco_data
+      or load_coco_store
 
     Optional arguments:
     - update_rule: A string giving the name of an update rule in optim.py.
@@ -81,6 +94,44 @@ class CaptioningSolver(object):
     - batch_size: Size of minibatches used to compute loss and gradient during
       training.
     - num_epochs: The number of epochs to run for during training.
+    - bucket_by_length: If True, every minibatch holds captions of a single
+      true length with the <NULL> padding trimmed; see sample_coco_minibatch.
+      Combine this with a model that skips padded timesteps (for example
+      CaptioningRNN with packed=True) to avoid work on padding entirely.
+    - epoch_sampling: If True, every epoch visits each training caption
+      exactly once, in a new random order each epoch; see EpochSampler. By
+      default minibatches are sampled independently with replacement.
+    - sort_window: Only used with epoch_sampling; if given, the random order
+      is sorted within windows of this many captions so that minibatch
+      gathers read rows in increasing order.
+    - prefetch: Integer; if positive, minibatches are prepared in a background
+      thread with up to this many minibatches queued ahead of the model; see
+      MinibatchPrefetcher. After training, solver.input_stall_time gives the
+      total time in seconds that training waited for input. Default is 0,
+      which samples minibatches synchronously.
+    - flat_params: If True, all model parameters, their gradients and the
+      optimizer state live in single flat buffers, and model.params holds
+      views into the parameter buffer. Each step then makes one vectorized
+      in-place update of the whole model instead of one update per
+      parameter. All parameters must have the same dtype.
+    - num_workers: Integer; if greater than 1, train data-parallel: each
+      minibatch is split into num_workers shards, and model.loss runs on the
+      shards in parallel in this process and num_workers - 1 forked worker
+      processes. The parameters and the per-worker gradients live in shared
+      memory, the gradients are summed after every step and a single
+      optimizer step updates the shared parameters. This implies
+      flat_params. Loss and gradients are the same as for the whole
+      minibatch, up to rounding (and up to the random negatives of a sampled
+      softmax). Limit each process to one BLAS thread, for example with
+      OMP_NUM_THREADS=1, so that the workers do not compete for cores.
+      Default is 1.
+    - num_train_samples: Number of training images used to check BLEU on the
+      training set; None uses all of them. Default is 1000.
+    - num_val_samples: Number of validation images used to check BLEU and the
+      loss on the validation set; None uses all of them. Default is 1000.
+    - num_val_loss_samples: Maximum number of reference captions of these
+      images used to compute the validation loss; None uses all of them.
+      Default is 1000.
     - print_every: Integer; training losses will be printed every print_every
       iterations.
     - verbose: Boolean; if set to false then no output will be printed during
@@ -95,6 +146,16 @@ class CaptioningSolver(object):
     self.lr_decay = kwargs.pop('lr_decay', 1.0)
     self.batch_size = kwargs.pop('batch_size', 100)
     self.num_epochs = kwargs.pop('num_epochs', 10)
+    self.bucket_by_length = kwargs.pop('bucket_by_length', False)
+    self.epoch_sampling = kwargs.pop('epoch_sampling', False)
+    self.sort_window = kwargs.pop('sort_window', None)
+    self.prefetch = kwargs.pop('prefetch', 0)
+    self.flat_params = kwargs.pop('flat_params', False)
+    self.num_workers = kwargs.pop('num_workers', 1)
+
+    self.num_train_samples = kwargs.pop('num_train_samples', 1000)
+    self.num_val_samples = kwargs.pop('num_val_samples', 1000)
+    self.num_val_loss_samples = kwargs.pop('num_val_loss_samples', 1000)
 
     self.print_every = kwargs.pop('print_every', 10)
     self.verbose = kwargs.pop('verbose', True)
@@ -104,10 +165,18 @@ class CaptioningSolver(object):
       extra = ', '.join('"%s"' % k for k in kwargs.keys())
       raise ValueError('Unrecognized arguments %s' % extra)
 
+    if self.num_workers < 1:
+      raise ValueError('num_workers must be positive, got %d' % self.num_workers)
+    if self.num_workers > 1:
+      self.flat_params = True
+
     # Make sure the update rule exists, then replace the string
     # name with the actual function
     if not hasattr(optim, self.update_rule):
       raise ValueError('Invalid update_rule "%s"' % self.update_rule)
+    # Row-sparse gradients (see CaptioningRNN's sparse_embedding) go to the
+    # sparse variant of the update rule, if there is one.
+    self.sparse_update_rule = getattr(optim, 'sparse_' + self.update_rule, None)
     self.update_rule = getattr(optim, self.update_rule)
 
     self._reset()
@@ -125,12 +194,60 @@ class CaptioningSolver(object):
     self.loss_history = []
     self.train_acc_history = []
     self.val_acc_history = []
-
-    # Make a deep copy of the optim_config for each parameter
+    self.val_loss_history = []
+    self.input_stall_time = 0.0
+    self._prefetcher = None
+    self._workers = []
+    self._processes = []
+    self._sampler = None
+    if self.epoch_sampling:
+      self._sampler = EpochSampler(self.data,
+                        batch_size=self.batch_size,
+                        split='train',
+                        bucket_by_length=self.bucket_by_length,
+                        sort_window=self.sort_window)
+
+    # Make a deep copy of the optim_config for each parameter; with flat
+    # parameters there is a single config for the whole flat buffer.
     self.optim_configs = {}
-    for p in self.model.params:
-      d = {k: v for k, v in self.optim_config.iteritems()}
-      self.optim_configs[p] = d
+    if self.flat_params:
+      self._flatten_params()
+      self.optim_configs['params'] = dict(self.optim_config)
+    else:
+      for p in self.model.params:
+        d = {k: v for k, v in self.optim_config.iteritems()}
+        self.optim_configs[p] = d
+
+
+  def _flatten_params(self):
+    """
+    Copy the model parameters into one flat buffer and replace them by views
+    into it, and allocate a matching flat gradient buffer. Don't call this
+    manually.
+    """
+    params = self.model.params
+    names = sorted(params)
+    dtypes = set(params[k].dtype for k in names)
+    if len(dtypes) != 1:
+      raise ValueError('flat_params requires all parameters to have the same '
+                       'dtype, got %s' % ', '.join(sorted(map(str, dtypes))))
+    dtype = dtypes.pop()
+    sizes = [params[k].size for k in names]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    if self.num_workers > 1:
+      # Parameters and one gradient buffer per worker are shared with the
+      # worker processes.
+      self._flat_w = _shared_empty(offsets[-1], dtype)
+      self._worker_dw = _shared_empty((self.num_workers, offsets[-1]), dtype)
+    else:
+      self._flat_w = np.empty(offsets[-1], dtype=dtype)
+    self._flat_dw = np.zeros_like(self._flat_w)
+    self._flat_slices = {}
+    for k, start, end in zip(names, offsets[:-1], offsets[1:]):
+      shape = params[k].shape
+      self._flat_w[start:end] = params[k].ravel()
+      params[k] = self._flat_w[start:end].reshape(shape)
+      self._flat_slices[k] = slice(start, end)
 
 
   def _step(self):
@@ -139,75 +256,233 @@ class CaptioningSolver(object):
     be called manually.
     """
     # Make a minibatch of training data
-    minibatch = sample_coco_minibatch(self.data,
-                  batch_size=self.batch_size,
-                  split='train')
+    if self._prefetcher is not None:
+      minibatch = self._prefetcher.get()
+    else:
+      minibatch = sample_coco_minibatch(self.data,
+                    batch_size=self.batch_size,
+                    split='train',
+                    bucket_by_length=self.bucket_by_length,
+                    sampler=self._sampler)
     captions, features, urls = minibatch
 
     # Compute loss and gradient
-    loss, grads = self.model.loss(features, captions)
+    if self._workers:
+      loss = self._parallel_loss(features, captions)
+    else:
+      loss, grads = self.model.loss(features, captions)
+      if self.flat_params:
+        _write_flat_grads(grads, self._flat_slices, self.model.params,
+                          self._flat_dw)
     self.loss_history.append(loss)
 
     # Perform a parameter update
+    if self.flat_params:
+      config = self.optim_configs['params']
+      next_w, next_config = self.update_rule(self._flat_w, self._flat_dw, config)
+      if next_w is not self._flat_w:
+        self._flat_w[...] = next_w
+      self.optim_configs['params'] = next_config
+      return
+
     for p, w in self.model.params.iteritems():
       dw = grads[p]
       config = self.optim_configs[p]
-      next_w, next_config = self.update_rule(w, dw, config)
+      update_rule = self.update_rule
+      if isinstance(dw, tuple):
+        if self.sparse_update_rule is None:
+          raise ValueError('Update rule "%s" does not support sparse gradients'
+                           % self.update_rule.__name__)
+        update_rule = self.sparse_update_rule
+      next_w, next_config = update_rule(w, dw, config)
       self.model.params[p] = next_w
       self.optim_configs[p] = next_config
 
   
-  # TODO: This does nothing right now; maybe implement BLEU?
-  def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+  def _parallel_loss(self, features, captions):
     """
-    Check accuracy of the model on the provided data.
-    
+    Compute the loss and the gradient of a minibatch with the worker
+    processes, leaving the gradient in the flat gradient buffer. This is
+    called by _step() and should not be called manually.
+    """
+    N = captions.shape[0]
+    shards = np.array_split(np.arange(N), self.num_workers)
+    for conn, shard in zip(self._workers, shards[1:]):
+      conn.send((features[shard], captions[shard], shard.shape[0] / float(N)))
+
+    # The first shard is computed in this process. Even if that fails, the
+    # replies of the workers are collected so that the pipes stay in sync.
+    loss, error = 0.0, None
+    try:
+      if shards[0].shape[0] > 0:
+        shard_loss, grads = self.model.loss(features[shards[0]],
+                                            captions[shards[0]])
+        scale = shards[0].shape[0] / float(N)
+        loss += scale * shard_loss
+        _write_flat_grads(grads, self._flat_slices, self.model.params,
+                          self._worker_dw[0], scale)
+      else:
+        self._worker_dw[0] = 0
+    except Exception:
+      error = traceback.format_exc()
+
+    for conn in self._workers:
+      status, value = conn.recv()
+      if status == 'error':
+        error = error or value
+      else:
+        loss += value
+    if error is not None:
+      raise RuntimeError('Error in data-parallel training:\n%s' % error)
+    np.sum(self._worker_dw, axis=0, out=self._flat_dw)
+    return loss
+
+
+  def _start_workers(self):
+    """
+    Fork the worker processes for data-parallel training. Don't call this
+    manually.
+    """
+    seeds = np.random.randint(2 ** 31, size=self.num_workers - 1)
+    for rank in xrange(1, self.num_workers):
+      conn, worker_conn = multiprocessing.Pipe()
+      process = multiprocessing.Process(target=_worker_loop,
+                  args=(self.model, worker_conn, self._flat_slices,
+                        self._worker_dw[rank], seeds[rank - 1]))
+      process.daemon = True
+      process.start()
+      worker_conn.close()
+      self._workers.append(conn)
+      self._processes.append(process)
+
+
+  def _stop_workers(self):
+    """
+    Shut down the worker processes. Don't call this manually.
+    """
+    for conn in self._workers:
+      conn.send(None)
+      conn.close()
+    for process in self._processes:
+      process.join()
+    self._workers = []
+    self._processes = []
+
+
+  def check_accuracy(self, split='val', num_samples=None, batch_size=100,
+                     max_length=30, compute_loss=True, num_loss_samples=None):
+    """
+    Evaluate the model on one split of the data: sample a caption for each
+    image and compute corpus BLEU against all reference captions of that
+    image, and compute the average loss of the reference captions.
+
     Inputs:
-    - X: Array of data, of shape (N, d_1, ..., d_k)
-    - y: Array of labels, of shape (N,)
-    - num_samples: If not None, subsample the data and only test the model
-      on num_samples datapoints.
-    - batch_size: Split X and y into batches of this size to avoid using too
-      much memory.
-      
-    Returns:
-    - acc: Scalar giving the fraction of instances that were correctly
-      classified by the model.
+    - split: Either 'train' or 'val'
+    - num_samples: If not None, subsample the images and only evaluate the
+      model on num_samples of them.
+    - batch_size: Sample captions and compute losses in batches of this size
+      to avoid using too much memory.
+    - max_length: Maximum length of the sampled captions.
+    - compute_loss: If False, skip computing the loss and return None for it.
+    - num_loss_samples: If not None, compute the loss on a random subset of
+      at most num_loss_samples of the reference captions.
+
+    Returns a tuple of:
+    - bleu: Scalar BLEU-4 score of the sampled captions
+    - loss: Scalar giving the average loss of the (subsampled) reference
+      captions
     """
-    return 0.0
-    
-    # Maybe subsample the data
-    N = X.shape[0]
-    if num_samples is not None and N > num_samples:
-      mask = np.random.choice(N, num_samples)
-      N = num_samples
-      X = X[mask]
-      y = y[mask]
-
-    # Compute predictions in batches
-    num_batches = N / batch_size
-    if N % batch_size != 0:
-      num_batches += 1
-    y_pred = []
-    for i in xrange(num_batches):
-      start = i * batch_size
-      end = (i + 1) * batch_size
-      scores = self.model.loss(X[start:end])
-      y_pred.append(np.argmax(scores, axis=1))
-    y_pred = np.hstack(y_pred)
-    acc = np.mean(y_pred == y)
-
-    return acc
+    captions = self.data['%s_captions' % split]
+    image_idxs = np.asarray(self.data['%s_image_idxs' % split])
+    features = self.data['%s_features' % split]
+
+    # Maybe subsample the images; evaluate them in sorted order so that
+    # gathering their features reads rows in file order.
+    images = np.unique(image_idxs)
+    if num_samples is not None and images.shape[0] > num_samples:
+      images = np.sort(np.random.choice(images, num_samples, replace=False))
+    N = images.shape[0]
+
+    # The reference captions of the chosen images, and which image each of
+    # them belongs to
+    ref_mask = np.flatnonzero(np.in1d(image_idxs, images))
+    references = captions[ref_mask]
+    owners = np.searchsorted(images, image_idxs[ref_mask])
+
+    # Sample captions in batches
+    samples = []
+    for start in xrange(0, N, batch_size):
+      batch_features = features[images[start:start + batch_size]]
+      samples.append(self.model.sample(batch_features, max_length=max_length))
+    samples = np.concatenate(samples, axis=0)
+    bleu = corpus_bleu(samples, references, owners, self.data['word_to_idx'])
+
+    if not compute_loss:
+      return bleu, None
+
+    # Compute the loss of the reference captions in batches; there are about
+    # five of them per image, so maybe subsample them.
+    if num_loss_samples is not None and ref_mask.shape[0] > num_loss_samples:
+      keep = np.random.choice(ref_mask.shape[0], num_loss_samples,
+                              replace=False)
+      keep.sort()
+      references, ref_mask = references[keep], ref_mask[keep]
+    total_loss = 0.0
+    M = references.shape[0]
+    for start in xrange(0, M, batch_size):
+      batch_captions = references[start:start + batch_size]
+      batch_features = features[image_idxs[ref_mask[start:start + batch_size]]]
+      loss, _ = self.model.loss(batch_features, batch_captions, mode='test')
+      total_loss += loss * batch_captions.shape[0]
+    return bleu, total_loss / max(M, 1)
 
 
   def train(self):
     """
     Run optimization to train the model.
     """
-    num_train = self.data['train_captions'].shape[0]
-    iterations_per_epoch = max(num_train / self.batch_size, 1)
+    if self._sampler is not None:
+      iterations_per_epoch = self._sampler.num_batches
+    else:
+      num_train = self.data['train_captions'].shape[0]
+      iterations_per_epoch = max(num_train / self.batch_size, 1)
     num_iterations = self.num_epochs * iterations_per_epoch
 
+    # Fork the workers before the prefetching thread is started
+    if self.num_workers > 1:
+      self._start_workers()
+    if self.prefetch > 0:
+      self._prefetcher = MinibatchPrefetcher(self.data,
+                           batch_size=self.batch_size,
+                           split='train',
+                           bucket_by_length=self.bucket_by_length,
+                           num_prefetch=self.prefetch,
+                           sampler=self._sampler)
+      self._prefetcher.start()
+    try:
+      self._train_loop(num_iterations, iterations_per_epoch)
+    finally:
+      if self._prefetcher is not None:
+        self._prefetcher.stop()
+        self.input_stall_time += self._prefetcher.stall_time
+        self._prefetcher = None
+      if self._workers:
+        self._stop_workers()
+
+    # At the end of training swap the best params into the model
+    if self.best_params:
+      if self.flat_params:
+        # Keep model.params as views into the flat buffer
+        for k, v in self.best_params.iteritems():
+          self.model.params[k][...] = v
+      else:
+        self.model.params = self.best_params
+
+
+  def _train_loop(self, num_iterations, iterations_per_epoch):
+    """
+    The body of train(). Don't call this manually.
+    """
     for t in xrange(num_iterations):
       self._step()
 
@@ -224,10 +499,84 @@ class CaptioningSolver(object):
         for k in self.optim_configs:
           self.optim_configs[k]['learning_rate'] *= self.lr_decay
 
-      # Check train and val accuracy on the first iteration, the last
-      # iteration, and at the end of each epoch.
-      # TODO: Implement some logic to check Bleu on validation set periodically
+      # Check train and val BLEU on the first iteration, the last iteration,
+      # and at the end of each epoch.
+      first_it = (t == 0)
+      last_it = (t == num_iterations - 1)
+      if first_it or last_it or epoch_end:
+        train_acc, _ = self.check_accuracy('train',
+                         num_samples=self.num_train_samples,
+                         compute_loss=False)
+        val_acc, val_loss = self.check_accuracy('val',
+                              num_samples=self.num_val_samples,
+                              num_loss_samples=self.num_val_loss_samples)
+        self.train_acc_history.append(train_acc)
+        self.val_acc_history.append(val_acc)
+        self.val_loss_history.append(val_loss)
+
+        if self.verbose:
+          print '(Epoch %d / %d) train BLEU: %f; val BLEU: %f; val loss: %f' % (
+                 self.epoch, self.num_epochs, train_acc, val_acc, val_loss)
+
+        # Keep track of the best model
+        if val_acc > self.best_val_acc:
+          self.best_val_acc = val_acc
+          self.best_params = {}
+          for k, v in self.model.params.iteritems():
+            self.best_params[k] = v.copy()
+
+
+
+def _shared_empty(shape, dtype):
+  """
+  Allocate a zero-filled array in shared memory, so that it is shared with
+  processes forked afterwards.
+  """
+  dtype = np.dtype(dtype)
+  size = int(np.prod(shape))
+  buf = multiprocessing.RawArray('b', max(size * dtype.itemsize, 1))
+  return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
 
-    # At the end of training swap the best params into the model
-    # self.model.params = self.best_params
 
+def _write_flat_grads(grads, slices, params, out, scale=1.0):
+  """
+  Write a dictionary of gradients, multiplied by scale, into the flat
+  gradient vector out laid out by slices.
+  """
+  for p, s in slices.iteritems():
+    dw = out[s].reshape(params[p].shape)
+    if isinstance(grads[p], tuple):
+      # The flat update touches every row anyway; scatter sparse rows.
+      scatter_sparse_rows(grads[p], dw)
+    else:
+      dw[...] = grads[p]
+    if scale != 1.0:
+      dw *= scale
+
+
+def _worker_loop(model, conn, slices, dw, seed):
+  """
+  Body of a data-parallel training worker. The worker receives shards of
+  minibatches as tuples (features, captions, scale), writes scale times the
+  gradient of the shard into its shared gradient buffer dw and sends back
+  ('ok', scale * loss), or ('error', traceback) if something went wrong. A
+  message of None shuts it down. model.params are views into shared memory,
+  so the worker always sees the latest parameters.
+  """
+  np.random.seed(seed)
+  while True:
+    msg = conn.recv()
+    if msg is None:
+      break
+    features, captions, scale = msg
+    try:
+      if captions.shape[0] == 0:
+        dw[...] = 0
+        loss = 0.0
+      else:
+        loss, grads = model.loss(features, captions)
+        _write_flat_grads(grads, slices, model.params, dw, scale)
+      conn.send(('ok', scale * loss))
+    except Exception:
+      conn.send(('error', traceback.format_exc()))
+  conn.close()
@@ -1,5 +1,6 @@
 import numpy as np
 
+from cs231n import rnn_layers
 from cs231n.layers import *
 from cs231n.rnn_layers import *
 
@@ -17,7 +18,9 @@ class CaptioningRNN(object):
   """
   
   def __init__(self, word_to_idx, input_dim=512, wordvec_dim=128,
-               hidden_dim=128, cell_type='rnn', dtype=np.float32):
+               hidden_dim=128, cell_type='rnn', dtype=np.float32,
+               bptt_steps=None, packed=False, num_sampled=None,
+               sparse_embedding=False, sparse_output=False):
     """
     Construct a new CaptioningRNN instance.
 
@@ -29,13 +32,50 @@ class CaptioningRNN(object):
     - hidden_dim: Dimension H for the hidden state of the RNN.
     - cell_type: What type of RNN to use; either 'rnn' or 'lstm'.
     - dtype: numpy datatype to use; use float32 for training and float64 for
-      numeric gradient checking.
+      numeric gradient checking. Image features are cast to this dtype, and
+      all activations and gradients are computed in it.
+    - bptt_steps: If not None, train with truncated backpropagation through
+      time: captions are processed in chunks of this many timesteps, carrying
+      the hidden (and cell) state across chunks but not the gradients. This
+      bounds the activation memory of loss() by the chunk length rather than
+      by the caption length.
+    - packed: If True, skip the work for padded timesteps in loss(). The
+      minibatch is sorted by caption length, the LSTM shrinks its active batch
+      as captions end, and scores and softmax are only computed at timesteps
+      that contribute to the loss. This gives the same loss and gradients.
+    - num_sampled: If not None, train with a sampled softmax: at training time
+      the softmax only runs over the words that appear in the minibatch plus
+      num_sampled draws (with replacement) uniformly at random from the
+      vocabulary, so the cost of the output layer no longer grows with the
+      vocabulary size. The scores of the sampled words that are not targets
+      of the minibatch are lowered by the log of their probability of being
+      drawn, which makes the softmax normalizer an unbiased estimate of the
+      full one; the loss itself is still a (slightly) biased estimate of the
+      full softmax loss. The exact softmax over the full vocabulary is still
+      used in test mode.
+    - sparse_embedding: If True, loss() returns the gradient of W_embed in
+      row-sparse form, as a tuple (ids, rows) holding only the rows of the
+      words in the minibatch; see word_embedding_backward. Update rules in
+      optim.py have sparse_ variants that only update these rows.
+    - sparse_output: If True and num_sampled is set, loss() returns the
+      gradients of W_vocab and b_vocab in sparse form, holding only the
+      candidate words of the sampled softmax: (ids, rows) for b_vocab and
+      (ids, rows, 1) for W_vocab, whose words are its columns. With a sparse_
+      update rule the cost of a training step is then nearly independent of
+      the vocabulary size.
     """
     if cell_type not in {'rnn', 'lstm'}:
       raise ValueError('Invalid cell_type "%s"' % cell_type)
+    if bptt_steps is not None and bptt_steps < 1:
+      raise ValueError('bptt_steps must be positive, got %d' % bptt_steps)
     
     self.cell_type = cell_type
     self.dtype = dtype
+    self.bptt_steps = bptt_steps
+    self.packed = packed
+    self.num_sampled = num_sampled
+    self.sparse_embedding = sparse_embedding
+    self.sparse_output = sparse_output
     self.word_to_idx = word_to_idx
     self.idx_to_word = {i: w for w, i in word_to_idx.iteritems()}
     self.params = {}
@@ -73,7 +113,7 @@ class CaptioningRNN(object):
       self.params[k] = v.astype(self.dtype)
 
 
-  def loss(self, features, captions):
+  def loss(self, features, captions, mode='train'):
     """
     Compute training-time loss for the RNN. We input image features and
     ground-truth captions for those images, and use an RNN (or LSTM) to compute
@@ -83,10 +123,14 @@ class CaptioningRNN(object):
     - features: Input image features, of shape (N, D)
     - captions: Ground-truth captions; an integer array of shape (N, T) where
       each element is in the range 0 <= y[i, t] < V
+    - mode: Either 'train' or 'test'. In test mode the loss always uses the
+      exact softmax over the full vocabulary, even if num_sampled is set, and
+      only the forward pass is run.
       
     Returns a tuple of:
     - loss: Scalar loss
-    - grads: Dictionary of gradients parallel to self.params
+    - grads: Dictionary of gradients parallel to self.params; empty in test
+      mode.
     """
     # Cut captions into two pieces: captions_in has everything but the last word
     # and will be input to the RNN; captions_out has everything but the first
@@ -94,12 +138,25 @@ class CaptioningRNN(object):
     # by one relative to each other because the RNN should produce word (t+1)
     # after receiving word t. The first element of captions_in will be the START
     # token, and the first element of captions_out will be the first word.
+    features = features.astype(self.dtype, copy=False)
     captions_in = captions[:, :-1]
     captions_out = captions[:, 1:]
     
     # You'll need this 
     mask = (captions_out != self._null)
 
+    lengths = None
+    if self.packed:
+      # Sort the minibatch from the longest to the shortest caption, so that the
+      # captions which are still running at any timestep form a prefix of the
+      # minibatch. We assume that <NULL> tokens only appear as padding at the
+      # end of captions.
+      lengths = mask.sum(axis=1)
+      order = np.argsort(-lengths, kind='mergesort')
+      features, lengths = features[order], lengths[order]
+      captions_in, captions_out = captions_in[order], captions_out[order]
+      mask = mask[order]
+
     # Weight and bias for the affine transform from image features to initial
     # hidden state
     W_proj, b_proj = self.params['W_proj'], self.params['b_proj']
@@ -138,6 +195,114 @@ class CaptioningRNN(object):
     # Fwd Pass Step 1: features is NxD. W_proj is DxH.
     (h0, h0_cache) = affine_forward(features, W_proj, b_proj)
 
+    # Steps 2-5 run over chunks of at most bptt_steps timesteps (a single chunk
+    # unless we use truncated BPTT). The hidden and cell states are carried from
+    # one chunk to the next, but each chunk is backpropagated right away so its
+    # caches can be freed; only the first chunk sends gradient into h0.
+    candidates = candidate_bias = None
+    if self.num_sampled is not None and mode == 'train':
+      # Sorted candidate set: every target word of the minibatch plus a sample
+      # of other words that act as negatives. Drawing with replacement keeps
+      # this independent of the vocabulary size.
+      vocab_size = W_vocab.shape[1]
+      targets = np.unique(captions_out)
+      sampled = np.random.randint(vocab_size, size=self.num_sampled)
+      candidates = np.union1d(targets, sampled)
+      # The targets are always candidates; any other word is one with
+      # probability p. Lowering its score by log(p) makes the sum of the
+      # exponentiated candidate scores an unbiased estimate of the sum over
+      # the whole vocabulary.
+      p = 1.0 - (1.0 - 1.0 / vocab_size) ** self.num_sampled
+      candidate_bias = np.where(np.in1d(candidates, targets), 0.0, -np.log(p))
+      candidate_bias = candidate_bias.astype(self.dtype)
+
+    backward = (mode == 'train')
+    T = captions_in.shape[1]
+    chunk = T if self.bptt_steps is None else self.bptt_steps
+    prev_h, prev_c = h0, None
+    for start in xrange(0, T, chunk):
+      end = start + chunk
+      chunk_lengths = None
+      if lengths is not None:
+        chunk_lengths = np.clip(lengths - start, 0, chunk)
+        if start > 0 and chunk_lengths.max() == 0:
+          # Every caption has ended; the remaining chunks are all padding and
+          # contribute neither loss nor gradient.
+          break
+      chunk_loss, dh, prev_h, prev_c = self._sequence_loss(
+        prev_h, prev_c, captions_in[:, start:end], captions_out[:, start:end],
+        mask[:, start:end], grads, lengths=chunk_lengths,
+        candidates=candidates, candidate_bias=candidate_bias,
+        backward=backward)
+      loss += chunk_loss
+      if start == 0:
+        dh0 = dh
+
+    if not backward:
+      return loss, grads
+
+    # Bkwd Pass Step 1
+    (_, grads['W_proj'], grads['b_proj']) = affine_backward(dh0, h0_cache)
+
+    if candidates is not None and not self.sparse_output:
+      for k in ('W_vocab', 'b_vocab'):
+        grads[k] = scatter_sparse_rows(grads[k], np.empty_like(self.params[k]))
+
+    for k, grad in grads.iteritems():
+      if isinstance(grad, tuple):
+        grad = grad[1]
+      rnn_layers.assert_no_upcast('CaptioningRNN.loss (%s)' % k,
+                                  [self.params[k]], [grad])
+    ############################################################################
+    #                             END OF YOUR CODE                             #
+    ############################################################################
+    return loss, grads
+
+
+  def _sequence_loss(self, h0, c0, captions_in, captions_out, mask, grads,
+                     lengths=None, candidates=None, candidate_bias=None,
+                     backward=True):
+    """
+    Run the word embedding, the RNN, the output projection and the softmax
+    loss forward and backward over one chunk of timesteps.
+
+    Inputs:
+    - h0: Initial hidden state, of shape (N, H)
+    - c0: Initial cell state of shape (N, H) for LSTMs; None means zeros.
+    - captions_in, captions_out, mask: Arrays of shape (N, T) for this chunk
+    - grads: Dictionary of gradients; the gradients of this chunk are added to
+      it, except for the image projection.
+    - lengths: If not None, an array of shape (N,) giving the number of
+      unpadded timesteps of each caption in this chunk, in non-increasing
+      order; padded timesteps are then skipped.
+    - candidates: If not None, a sorted array of word indices that contains
+      every word in captions_out; scores and the softmax are then only
+      computed over these words, and the gradients of W_vocab and b_vocab
+      are added to grads in sparse form.
+    - candidate_bias: Array of the same shape as candidates, added to the
+      scores of the candidate words.
+    - backward: If False, only run the forward pass; grads is left alone and
+      dh0 is None.
+
+    Returns a tuple of:
+    - loss: Scalar loss of this chunk
+    - dh0: Gradient of the loss with respect to h0
+    - hT: Hidden state after the last timestep of the chunk
+    - cT: Cell state after the last timestep of the chunk (None for RNNs)
+    """
+    W_embed = self.params['W_embed']
+    Wx, Wh, b = self.params['Wx'], self.params['Wh'], self.params['b']
+    W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
+    chunk_grads = {}
+
+    if candidates is not None:
+      # Restrict the output layer to the candidate words and renumber the
+      # targets to index into the candidate set.
+      W_vocab, b_vocab = W_vocab[:, candidates], b_vocab[candidates]
+      if candidate_bias is not None:
+        b_vocab = b_vocab + candidate_bias
+      captions_out = np.searchsorted(candidates, captions_out)
+
     # Fwd Pass Step 2: change words from indices to vectors
     # data is then (N,T,W). (W is called D inside word_embedding_fwd)
     (data, word_embedding_cache) = word_embedding_forward(captions_in, W_embed)
@@ -146,44 +311,113 @@ class CaptioningRNN(object):
     if self.cell_type == "rnn":
       (hidden_states, rnn_forward_cache) = rnn_forward(data, h0, Wx, Wh, b)
       # hidden_states has dimension (N, T, H)
+      cT = None
     else:
-      (hidden_states, rnn_forward_cache) = lstm_forward(data, h0, Wx, Wh, b)
-
-    # Fwd Pass Step 4: compute scores over vocabulary @ every
-    # what here is V is refered to as M inside temporal_affine_fwd()
-    # what here is H is refered to as D inside temporal_affine_fwd()
-    (scores, temporal_affine_cache) = temporal_affine_forward(
-      hidden_states, W_vocab, b_vocab)
-    # scores is (N, T, M) ... aka (N, T, V)
-    
-    # Fwd Pass Step 5:
-    (loss, dscores) = temporal_softmax_loss(
-      scores, captions_out, mask, verbose=False)
+      (hidden_states, rnn_forward_cache) = lstm_forward(data, h0, Wx, Wh, b,
+                                                        c0=c0, lengths=lengths)
+      cT = rnn_forward_cache.c[-1].copy()
+    # copy, so the carried state does not keep the caches of this chunk alive
+    hT = hidden_states[:, -1, :].copy()
+
+    if lengths is None:
+      # Fwd Pass Step 4: compute scores over vocabulary @ every
+      # what here is V is refered to as M inside temporal_affine_fwd()
+      # what here is H is refered to as D inside temporal_affine_fwd()
+      (scores, temporal_affine_cache) = temporal_affine_forward(
+        hidden_states, W_vocab, b_vocab)
+      # scores is (N, T, M) ... aka (N, T, V)
+      
+      # Fwd Pass Step 5:
+      (loss, dscores) = temporal_softmax_loss(
+        scores, captions_out, mask, verbose=False)
+
+      # Backward Pass
+      # Bkwd Pass Step 5. Noop, we got it from the fwd pass which computes
+      # dscores should be shape (N, T, V)
+
+      # Bkwd Pass Step 4
+      if backward:
+        (dhidden_states, chunk_grads['W_vocab'], chunk_grads['b_vocab']
+        ) = temporal_affine_backward(dscores, temporal_affine_cache)
+    else:
+      (loss, dhidden_states, chunk_grads['W_vocab'], chunk_grads['b_vocab']
+      ) = self._packed_output_loss(hidden_states, captions_out, mask,
+                                   W_vocab, b_vocab, backward=backward)
 
-    # Backward Pass
-    # Bkwd Pass Step 5. Noop, we got it from the fwd pass which computes dscores
-    # should be shape (N, T, V)
+    if not backward:
+      return loss, None, hT, cT
 
-    # Bkwd Pass Step 4
-    (dhidden_states, grads['W_vocab'], grads['b_vocab']
-    ) = temporal_affine_backward(dscores, temporal_affine_cache)
+    if candidates is not None:
+      # Only the candidate columns of the output layer get gradient
+      chunk_grads['W_vocab'] = (candidates, chunk_grads['W_vocab'].T, 1)
+      chunk_grads['b_vocab'] = (candidates, chunk_grads['b_vocab'])
     
     # Bkwd Pass Step 3
     if self.cell_type == "rnn":
-      (ddata, dh0, grads['Wx'], grads['Wh'], grads['b']) = rnn_backward(
-        dhidden_states, rnn_forward_cache)
+      (ddata, dh0, chunk_grads['Wx'], chunk_grads['Wh'], chunk_grads['b']
+      ) = rnn_backward(dhidden_states, rnn_forward_cache)
     else:
-      (ddata, dh0, grads['Wx'], grads['Wh'], grads['b']) = lstm_backward(
-        dhidden_states, rnn_forward_cache)
+      (ddata, dh0, chunk_grads['Wx'], chunk_grads['Wh'], chunk_grads['b']
+      ) = lstm_backward(dhidden_states, rnn_forward_cache)
 
     # Bkwd Pass Step 2
-    grads['W_embed'] = word_embedding_backward(ddata, word_embedding_cache)
-    # Bkwd Pass Step 1
-    (_, grads['W_proj'], grads['b_proj']) = affine_backward(dh0, h0_cache)
-    ############################################################################
-    #                             END OF YOUR CODE                             #
-    ############################################################################
-    return loss, grads
+    chunk_grads['W_embed'] = word_embedding_backward(ddata,
+                                 word_embedding_cache,
+                                 sparse=self.sparse_embedding)
+
+    for k, grad in chunk_grads.iteritems():
+      if k not in grads:
+        grads[k] = grad
+      elif isinstance(grad, tuple):
+        grads[k] = add_sparse_rows(grads[k], grad)
+      else:
+        grads[k] += grad
+    return loss, dh0, hT, cT
+
+
+  def _packed_output_loss(self, hidden_states, captions_out, mask, W_vocab,
+                          b_vocab, backward=True):
+    """
+    Compute the output projection and softmax loss, and their backward pass,
+    only at the timesteps where mask is True. This matches the loss and
+    gradients of temporal_affine_forward followed by temporal_softmax_loss,
+    but padded timesteps cost no matrix multiply or softmax.
+
+    Inputs:
+    - hidden_states: Hidden states of shape (N, T, H)
+    - captions_out, mask: Arrays of shape (N, T)
+    - W_vocab, b_vocab: Weights and biases of the output projection
+    - backward: If False, only compute the loss; the gradients are None.
+
+    Returns a tuple of:
+    - loss: Scalar loss, averaged over the minibatch
+    - dhidden_states: Gradient of hidden_states, of shape (N, T, H)
+    - dW_vocab, db_vocab: Gradients of the output projection
+    """
+    N = hidden_states.shape[0]
+    if not mask.any():
+      return (0.0, np.zeros_like(hidden_states), np.zeros_like(W_vocab),
+              np.zeros_like(b_vocab))
+
+    # packed arrays of shape (M, H) and (M,) for the M unmasked timesteps
+    h_packed = hidden_states[mask]
+    y_packed = captions_out[mask]
+    M = y_packed.shape[0]
+
+    scores, affine_cache = affine_forward(h_packed, W_vocab, b_vocab)
+    # temporal_softmax_loss averages over its first dimension, which is 1 here
+    loss, dscores = temporal_softmax_loss(scores[None], y_packed[None],
+                                          np.ones((1, M), dtype=bool))
+    loss /= N
+    if not backward:
+      return loss, None, None, None
+    dscores = dscores[0]
+    dscores /= N
+    dh_packed, dW_vocab, db_vocab = affine_backward(dscores, affine_cache)
+
+    dhidden_states = np.zeros_like(hidden_states)
+    dhidden_states[mask] = dh_packed
+    return loss, dhidden_states, dW_vocab, db_vocab
 
 
   def sample(self, features, max_length=30):
@@ -209,8 +443,10 @@ class CaptioningRNN(object):
     - captions: Array of shape (N, max_length) giving sampled captions,
       where each element is an integer in the range [0, V). The first element
       of captions should be the first sampled word, not the <START> token.
+      Captions are padded with <NULL> after their <END> token.
     """
     N = features.shape[0]
+    features = features.astype(self.dtype, copy=False)
     captions = self._null * np.ones((N, max_length), dtype=np.int32)
 
     # Unpack parameters
@@ -243,39 +479,143 @@ class CaptioningRNN(object):
 
     # initialize cur_h to h0, which is of dim NxH
     cur_h, _ = affine_forward(features, W_proj, b_proj)
-    # build an N element array of <START> tokens in each position
-    cur_word = np.empty(1, dtype=int) #type needed b/c it's an index
-    cur_word[0] = self._start
-    cur_words = np.tile(cur_word, N).reshape((N, 1))
+    # an N element array of <START> tokens
+    cur_words = self._start * np.ones(N, dtype=np.int32)
 
     cur_c = np.zeros_like(cur_h) # needed for LSTMs only
 
+    # Indices of the captions that have not produced <END> yet. Finished rows
+    # are compacted out of the state arrays, so later timesteps only compute
+    # the captions that are still running, and we stop once all are done.
+    active = np.arange(N)
+
     for t in xrange(max_length):
-      # convert from cur_words to the embedded vector representation
-      cur_words_vec, _ = word_embedding_forward(cur_words, W_embed)
-      # this index on cur_words_vec converts from Nx1xD to NxD
-      x = cur_words_vec[:, 0, :]
+      # convert from cur_words to the embedded vector representation, NxW
+      x = W_embed[cur_words]
       if self.cell_type == 'rnn':
         cur_h, _ = rnn_step_forward(x, cur_h, Wx, Wh, b)
       else:
         (cur_h, cur_c, _) = lstm_step_forward(x, cur_h, cur_c, Wx, Wh, b)
 
-      # cur_h is NxH. convert it to Nx1xH
-      tmp = cur_h.reshape([cur_h.shape[0], 1, cur_h.shape[1]])
-      scores, _ = temporal_affine_forward(tmp, W_vocab, b_vocab)
-      
-      # convert from Nx1xV to NxV
-      scores = scores[:, 0, :]
+      # scores for all words in the vocabulary, of shape NxV
+      scores = cur_h.dot(W_vocab) + b_vocab
 
-      # generate a N element vector which is argmax over axis=1, then convert
-      # to an Nx1 element array
-      cur_words = np.argmax(scores, axis=1).reshape([cur_words.shape[0], 1])
+      # pick the best word for every running caption and write it to the
+      # column for this timestep
+      cur_words = np.argmax(scores, axis=1)
+      captions[active, t] = cur_words
 
-      # insert current N words into the column for the N words at this time
-      captions[:, t] = cur_words[:, 0]
-      pass
+      running = (cur_words != self._end)
+      if not running.all():
+        active = active[running]
+        if active.shape[0] == 0:
+          break
+        cur_h, cur_c = cur_h[running], cur_c[running]
+        cur_words = cur_words[running]
 
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
     return captions
+
+
+  def sample_beam(self, features, beam_size=3, max_length=30):
+    """
+    Run a test-time forward pass for the model, decoding captions with beam
+    search instead of greedy sampling.
+
+    For each image we keep the beam_size partial captions with the highest
+    total log-probability. The hypotheses of all N images are flattened into a
+    single minibatch of N * beam_size rows, so each timestep is one RNN step
+    and one vocabulary projection for the whole batch. After each step the
+    hidden (and cell) states are reordered with a single gather to follow the
+    surviving hypotheses.
+
+    A hypothesis is finished once it emits the <END> token. Since adding words
+    can only lower the log-probability of a caption, an image is done as soon
+    as its best hypothesis is finished; done images are dropped from the batch,
+    and decoding stops early once every image is done.
+
+    Inputs:
+    - features: Array of input image features of shape (N, D).
+    - beam_size: Number of hypotheses B to keep for each image.
+    - max_length: Maximum length T of generated captions.
+
+    Returns:
+    - captions: Array of shape (N, max_length) giving the best caption found
+      for each image, in the same format as the output of sample().
+    """
+    N = features.shape[0]
+    B = beam_size
+    features = features.astype(self.dtype, copy=False)
+    captions = self._null * np.ones((N, max_length), dtype=np.int32)
+
+    # Unpack parameters
+    W_proj, b_proj = self.params['W_proj'], self.params['b_proj']
+    W_embed = self.params['W_embed']
+    Wx, Wh, b = self.params['Wx'], self.params['Wh'], self.params['b']
+    W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
+    V = W_vocab.shape[1]
+
+    # State of the A images that are still being decoded. Rows of the flattened
+    # arrays are ordered image-major: row a * B + k is hypothesis k of image a.
+    active = np.arange(N)
+    h0, _ = affine_forward(features, W_proj, b_proj)
+    cur_h = np.repeat(h0, B, axis=0)
+    cur_c = np.zeros_like(cur_h) # needed for LSTMs only
+    cur_words = self._start * np.ones(N * B, dtype=np.int32)
+    seqs = self._null * np.ones((N * B, max_length), dtype=np.int32)
+    finished = np.zeros(N * B, dtype=bool)
+    # All hypotheses of an image start out identical, so only the first one
+    # may be extended at the first timestep.
+    beam_scores = np.zeros((N, B))
+    beam_scores[:, 1:] = -np.inf
+
+    for t in xrange(max_length):
+      A = active.shape[0]
+      x = W_embed[cur_words]
+      if self.cell_type == 'rnn':
+        cur_h, _ = rnn_step_forward(x, cur_h, Wx, Wh, b)
+      else:
+        cur_h, cur_c, _ = lstm_step_forward(x, cur_h, cur_c, Wx, Wh, b)
+
+      # log-probabilities of the next word, of shape (A * B, V)
+      scores = cur_h.dot(W_vocab) + b_vocab
+      scores -= scores.max(axis=1, keepdims=True)
+      logp = scores - np.log(np.exp(scores).sum(axis=1, keepdims=True))
+      # finished hypotheses can only be extended by <NULL>, at no cost
+      logp[finished] = -np.inf
+      logp[finished, self._null] = 0
+
+      # pick the B best extensions of each image, sorted best first
+      total = (beam_scores.reshape(A * B, 1) + logp).reshape(A, B * V)
+      rows = np.arange(A)[:, None]
+      best = np.argpartition(-total, B - 1, axis=1)[:, :B]
+      best = best[rows, np.argsort(-total[rows, best], axis=1)]
+      beam_scores = total[rows, best]
+
+      # gather the states of the hypotheses that were extended
+      parents = (best / V + rows * B).ravel()
+      cur_words = (best % V).ravel().astype(np.int32)
+      cur_h, cur_c = cur_h[parents], cur_c[parents]
+      seqs, finished = seqs[parents], finished[parents]
+      seqs[:, t] = cur_words
+      finished |= (cur_words == self._end)
+
+      # images whose best hypothesis has finished are done
+      done = finished.reshape(A, B)[:, 0]
+      if done.any():
+        captions[active[done]] = seqs.reshape(A, B, max_length)[done, 0]
+        keep = ~done
+        active, beam_scores = active[keep], beam_scores[keep]
+        keep_rows = np.repeat(keep, B)
+        cur_h, cur_c, cur_words = (cur_h[keep_rows], cur_c[keep_rows],
+                                   cur_words[keep_rows])
+        seqs, finished = seqs[keep_rows], finished[keep_rows]
+        if active.shape[0] == 0:
+          break
+
+    # images that ran out of timesteps get their best unfinished hypothesis
+    if active.shape[0] > 0:
+      captions[active] = seqs.reshape(-1, B, max_length)[:, 0]
+    return captions
@@ -1,30 +1,41 @@
-import os, json
+import os, json, threading, time
+from Queue import Queue, Empty, Full
 import numpy as np
 import h5py
 
 
 def load_coco_data(base_dir='cs231n/datasets/coco_captioning',
                    max_train=None,
-                   pca_features=True):
+                   pca_features=True,
+                   lazy=False):
+  """
+  Load the COCO captioning data into a dictionary.
+
+  If lazy is True, nothing big is read at load time: the HDF5 datasets
+  (captions, image indices and features) are returned as read-only memory
+  maps of the HDF5 files, or as LazyDataset views when a dataset is chunked or
+  compressed and so cannot be mapped, and the urls are returned as
+  LazyLines. All of these support the same indexing as the arrays returned in
+  the eager mode, and only read the rows that are indexed, so startup is fast
+  and the full 4096-dimensional features do not have to fit in memory.
+  """
   data = {}
   caption_file = os.path.join(base_dir, 'coco2014_captions.h5')
-  with h5py.File(caption_file, 'r') as f:
-    for k, v in f.iteritems():
-      data[k] = np.asarray(v)
+  data.update(_load_h5(caption_file, lazy))
 
   if pca_features:
     train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7_pca.h5')
   else:
     train_feat_file = os.path.join(base_dir, 'train2014_vgg16_fc7.h5')
-  with h5py.File(train_feat_file, 'r') as f:
-    data['train_features'] = np.asarray(f['features'])
+  features = _load_h5(train_feat_file, lazy, ['features'])
+  data['train_features'] = features['features']
 
   if pca_features:
     val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7_pca.h5')
   else:
     val_feat_file = os.path.join(base_dir, 'val2014_vgg16_fc7.h5')
-  with h5py.File(val_feat_file, 'r') as f:
-    data['val_features'] = np.asarray(f['features'])
+  features = _load_h5(val_feat_file, lazy, ['features'])
+  data['val_features'] = features['features']
 
   dict_file = os.path.join(base_dir, 'coco2014_vocab.json')
   with open(dict_file, 'r') as f:
@@ -33,52 +44,777 @@ def load_coco_data(base_dir='cs231n/datasets/coco_captioning',
       data[k] = v
 
   train_url_file = os.path.join(base_dir, 'train2014_urls.txt')
-  with open(train_url_file, 'r') as f:
-    train_urls = np.asarray([line.strip() for line in f])
-  data['train_urls'] = train_urls
+  if lazy:
+    data['train_urls'] = LazyLines(train_url_file)
+  else:
+    with open(train_url_file, 'r') as f:
+      train_urls = np.asarray([line.strip() for line in f])
+    data['train_urls'] = train_urls
 
   val_url_file = os.path.join(base_dir, 'val2014_urls.txt')
-  with open(val_url_file, 'r') as f:
-    val_urls = np.asarray([line.strip() for line in f])
-  data['val_urls'] = val_urls
+  if lazy:
+    data['val_urls'] = LazyLines(val_url_file)
+  else:
+    with open(val_url_file, 'r') as f:
+      val_urls = np.asarray([line.strip() for line in f])
+    data['val_urls'] = val_urls
+
+  # Maybe subsample the training data
+  if max_train is not None:
+    num_train = data['train_captions'].shape[0]
+    # Sample without replacement, and read the rows in file order
+    mask = np.random.choice(num_train, min(max_train, num_train), replace=False)
+    mask.sort()
+    data['train_captions'] = data['train_captions'][mask]
+    data['train_image_idxs'] = data['train_image_idxs'][mask]
+
+  return data
+
+
+def _load_h5(filename, lazy, keys=None):
+  """
+  Load the datasets named in keys (all of them if keys is None) from an HDF5
+  file into a dictionary, as arrays or, if lazy is True, with _load_lazy.
+  The file is closed again unless one of the datasets was returned as a
+  LazyDataset, which keeps reading from it.
+  """
+  load = _load_lazy if lazy else np.asarray
+  f = h5py.File(filename, 'r')
+  keep_open = False
+  try:
+    if keys is None:
+      keys = f.keys()
+    data = {}
+    for k in keys:
+      data[k] = load(f[k])
+      keep_open = keep_open or isinstance(data[k], LazyDataset)
+  finally:
+    if not keep_open:
+      f.close()
+  return data
+
+
+def _load_lazy(dset):
+  """
+  Return a read-only view of an HDF5 dataset that reads rows on demand.
+  Contiguous, uncompressed datasets are memory mapped straight from the HDF5
+  file; anything else is wrapped in a LazyDataset.
+  """
+  offset = dset.id.get_offset()
+  if dset.chunks is None and offset is not None and dset.dtype.kind in 'biuf':
+    return np.memmap(dset.file.filename, dtype=dset.dtype, mode='r',
+                     offset=offset, shape=dset.shape)
+  return LazyDataset(dset)
+
+
+class LazyDataset(object):
+  """
+  Read-only view of an HDF5 dataset supporting the numpy indexing used on the
+  COCO data: integers, slices and integer arrays along the first axis. Only
+  the rows that are indexed are read from disk.
+  """
+
+  def __init__(self, dset):
+    self.dset = dset
+    self.shape = dset.shape
+    self.dtype = dset.dtype
+    self.ndim = len(dset.shape)
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __array__(self, dtype=None):
+    return np.asarray(self.dset[...], dtype=dtype)
+
+  def __getitem__(self, idx):
+    if isinstance(idx, (list, np.ndarray)):
+      idx = np.asarray(idx)
+      if idx.dtype == np.bool:
+        idx = np.flatnonzero(idx)
+      idx = np.where(idx < 0, idx + self.shape[0], idx)
+      # h5py wants increasing indices without repeats
+      uniq, inverse = np.unique(idx.ravel(), return_inverse=True)
+      if uniq.shape[0] == 0:
+        rows = np.empty((0,) + self.shape[1:], dtype=self.dtype)
+      else:
+        rows = self.dset[uniq.tolist()]
+      return rows[inverse].reshape(idx.shape + self.shape[1:])
+    return self.dset[idx]
+
+
+class LazyLines(object):
+  """
+  Read-only view of the lines of a text file, indexed like a numpy string
+  array. Line offsets are found once by scanning a memory map of the file
+  for newlines; the lines themselves are only read when indexed.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self._bytes = np.memmap(filename, dtype=np.uint8, mode='r')
+    ends = np.flatnonzero(self._bytes == ord('\n'))
+    if self._bytes.shape[0] > 0 and self._bytes[-1] != ord('\n'):
+      ends = np.append(ends, self._bytes.shape[0])
+    self._starts = np.concatenate([[0], ends[:-1] + 1])
+    self._ends = ends
+    self.shape = ends.shape
+    self.ndim = 1
+
+  def __len__(self):
+    return self.shape[0]
+
+  def _line(self, i):
+    return self._bytes[self._starts[i]:self._ends[i]].tostring().strip()
+
+  def __array__(self, dtype=None):
+    return np.asarray([self._line(i) for i in xrange(len(self))], dtype=dtype)
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      idx = np.arange(len(self))[idx]
+    if isinstance(idx, (list, np.ndarray)):
+      idx = np.asarray(idx)
+      if idx.dtype == np.bool:
+        idx = np.flatnonzero(idx)
+      lines = [self._line(i) for i in idx.ravel()]
+      return np.asarray(lines).reshape(idx.shape)
+    return self._line(idx)
+
+
+def convert_coco_data(base_dir='cs231n/datasets/coco_captioning',
+                      out_dir=None, pca_features=True, chunk_size=4096):
+  """
+  One-time conversion of the COCO HDF5 bundle into a feature store for
+  load_coco_store: every array (captions, image indices, features and urls)
+  is written as a flat little-endian binary file, and a small JSON header
+  (header.json) records the file, dtype and shape of each array together with
+  the vocabulary. Features are copied chunk_size rows at a time, so the full
+  4096-dimensional features never have to fit in memory.
+
+  Returns the directory the store was written to; by default this is
+  base_dir/store_pca or base_dir/store_fc7.
+  """
+  if out_dir is None:
+    out_dir = os.path.join(base_dir, 'store_pca' if pca_features else 'store_fc7')
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+
+  data = load_coco_data(base_dir, pca_features=pca_features, lazy=True)
+  header = {'arrays': {}}
+  for k, v in data.iteritems():
+    if isinstance(v, (dict, list)):
+      header[k] = v
+      continue
+    if isinstance(v, LazyLines):
+      v = np.asarray(v)
+    dtype = v.dtype.newbyteorder('<')
+    filename = '%s.bin' % k
+    with open(os.path.join(out_dir, filename), 'wb') as f:
+      for start in xrange(0, v.shape[0], chunk_size):
+        chunk = np.asarray(v[start:start + chunk_size])
+        f.write(np.ascontiguousarray(chunk, dtype=dtype).tostring())
+    header['arrays'][k] = {'file': filename, 'dtype': dtype.str,
+                           'shape': list(v.shape)}
+
+  with open(os.path.join(out_dir, 'header.json'), 'w') as f:
+    json.dump(header, f)
+  return out_dir
+
+
+def load_coco_store(store_dir, max_train=None):
+  """
+  Open a feature store written by convert_coco_data. Every array is a
+  read-only np.memmap of its binary file, so opening the store is instant and
+  minibatch gathers only touch the rows they need. The result has the same
+  keys as the output of load_coco_data and can be passed to
+  CaptioningSolver in its place.
+  """
+  with open(os.path.join(store_dir, 'header.json'), 'r') as f:
+    header = json.load(f)
+
+  data = {}
+  for k, v in header.iteritems():
+    if k != 'arrays':
+      data[k] = v
+  for k, info in header['arrays'].iteritems():
+    data[k] = np.memmap(os.path.join(store_dir, info['file']),
+                        dtype=np.dtype(str(info['dtype'])), mode='r',
+                        shape=tuple(info['shape']))
 
   # Maybe subsample the training data
   if max_train is not None:
     num_train = data['train_captions'].shape[0]
-    mask = np.random.randint(num_train, size=max_train)
+    # Sample without replacement, and read the rows in file order
+    mask = np.random.choice(num_train, min(max_train, num_train), replace=False)
+    mask.sort()
     data['train_captions'] = data['train_captions'][mask]
     data['train_image_idxs'] = data['train_image_idxs'][mask]
 
   return data
 
 
+class VocabTable(object):
+  """
+  A lookup table for decoding captions, built once per vocabulary: words is
+  an object array mapping word indices to ' ' + word, with '' for <NULL>, and
+  null_idx and end_idx are the indices of <NULL> and <END> (None if the
+  vocabulary has no such token). Use vocab_table to get the cached table of a
+  vocabulary.
+  """
+  def __init__(self, idx_to_word):
+    self.idx_to_word = idx_to_word
+    # idx_to_word may be a list or a dictionary {index: word}
+    words = [idx_to_word[i] for i in xrange(len(idx_to_word))]
+    self.words = np.empty(len(words), dtype=object)
+    self.words[:] = [' ' + w for w in words]
+    self.null_idx = self.end_idx = None
+    for i, w in enumerate(words):
+      if w == '<NULL>' and self.null_idx is None:
+        self.null_idx = i
+      if w == '<END>' and self.end_idx is None:
+        self.end_idx = i
+    if self.null_idx is not None:
+      self.words[self.null_idx] = ''
+
+
+_vocab_tables = {}
+
+
+def vocab_table(idx_to_word):
+  """
+  Return the VocabTable of a vocabulary, building it on first use.
+  """
+  table = _vocab_tables.get(id(idx_to_word))
+  if (table is None or table.idx_to_word is not idx_to_word
+      or len(table.words) != len(idx_to_word)):
+    table = _vocab_tables[id(idx_to_word)] = VocabTable(idx_to_word)
+  return table
+
+
 def decode_captions(captions, idx_to_word):
+  """
+  Turn captions of word indices into strings. Each caption is cut after its
+  first <END> token and <NULL> tokens are dropped.
+
+  Inputs:
+  - captions: Integer array of shape (N, T), or (T,) for a single caption
+  - idx_to_word: List or dictionary mapping word indices to words
+
+  Returns:
+  - decoded: List of N strings, or a single string for a single caption
+  """
   singleton = False
   if captions.ndim == 1:
     singleton = True
     captions = captions[None]
-  decoded = []
-  N, T = captions.shape
-  for i in xrange(N):
-    words = []
-    for t in xrange(T):
-      word = idx_to_word[captions[i, t]]
-      if word != '<NULL>':
-        words.append(word)
-      if word == '<END>':
-        break
-    decoded.append(' '.join(words))
+  decoded = _decode_batch(np.asarray(captions), vocab_table(idx_to_word))
   if singleton:
     decoded = decoded[0]
   return decoded
 
 
-def sample_coco_minibatch(data, batch_size=100, split='train'):
-  split_size = data['%s_captions' % split].shape[0]
-  mask = np.random.choice(split_size, batch_size)
+def iter_decode_captions(captions, idx_to_word, batch_size=10000):
+  """
+  Decode a large array of captions batch_size captions at a time, yielding
+  the strings one by one; this keeps the memory for the intermediate arrays
+  bounded however many captions there are. captions may be anything that
+  can be sliced along its first axis, such as a memory mapped array.
+  """
+  table = vocab_table(idx_to_word)
+  for start in xrange(0, captions.shape[0], batch_size):
+    batch = np.asarray(captions[start:start + batch_size])
+    for caption in _decode_batch(batch, table):
+      yield caption
+
+
+def _first_end(captions, end_idx):
+  """
+  Find the position of the first end_idx in each row of captions, which has
+  shape (N, T); rows without one get T.
+  """
+  N, T = captions.shape
+  if T == 0:
+    # argmax refuses an empty axis
+    return np.zeros(N, dtype=np.int64)
+  is_end = captions == end_idx
+  return np.where(is_end.any(axis=1), is_end.argmax(axis=1), T)
+
+
+def _decode_batch(captions, table):
+  """
+  Decode captions of shape (N, T) without looping over tokens in Python.
+  """
+  N, T = captions.shape
+  words = table.words[captions]
+  if table.end_idx is not None:
+    # Blank out everything after the first <END> of each caption
+    end = _first_end(captions, table.end_idx)
+    words[np.arange(T) > end[:, None]] = ''
+  # Every word carries a leading space, so joining a whole batch with a
+  # newline after each caption and then dropping the space that follows each
+  # newline gives all of the captions in one string.
+  lines = np.empty((N, T + 1), dtype=object)
+  lines[:, :T] = words
+  lines[:, T] = '\n'
+  text = ('\n' + ''.join(lines.ravel())).replace('\n ', '\n')
+  return text[1:-1].split('\n') if N > 0 else []
+
+
+def _strip_captions(captions, word_to_idx):
+  """
+  Cut each caption after its first <END> and drop the <NULL>, <START> and
+  <END> tokens, packing the remaining words to the left.
+
+  Returns a tuple of:
+  - words: Integer array of shape (N, T); entries past each length are junk
+  - lengths: Integer array of shape (N,) giving the number of words
+  """
+  special = [word_to_idx[w] for w in ('<NULL>', '<START>', '<END>')
+             if w in word_to_idx]
+  N, T = captions.shape
+  keep = ~np.in1d(captions, special).reshape(N, T)
+  if '<END>' in word_to_idx:
+    end = _first_end(captions, word_to_idx['<END>'])
+    keep &= np.arange(T) < end[:, None]
+  order = np.argsort(~keep, axis=1, kind='mergesort')
+  words = captions[np.arange(N)[:, None], order]
+  return words, keep.sum(axis=1)
+
+
+def _ngram_keys(words, lengths, owners, n, base):
+  """
+  Encode every n-gram of every caption together with the owner of the
+  caption as one integer owner * base**n + code, where code is the n-gram
+  read as a number in base base.
+
+  Returns a flat integer array of keys.
+  """
+  N, T = words.shape
+  if T < n:
+    return np.zeros(0, dtype=np.int64)
+  codes = np.zeros((N, T - n + 1), dtype=np.int64)
+  for k in xrange(n):
+    codes = codes * base + words[:, k:T - n + 1 + k]
+  valid = np.arange(T - n + 1) <= (lengths - n)[:, None]
+  keys = owners[:, None].astype(np.int64) * base ** n + codes
+  return keys[valid]
+
+
+def corpus_bleu(candidates, references, reference_owners, word_to_idx,
+                max_n=4):
+  """
+  Compute corpus-level BLEU of candidate captions against reference
+  captions, working directly on the integer word indices: n-grams are
+  encoded as integers and counted with np.unique rather than with strings
+  and dictionaries. Captions are cut after their first <END>, and <NULL>,
+  <START> and <END> tokens are ignored.
+
+  Inputs:
+  - candidates: Integer array of shape (N, T1) of candidate captions
+  - references: Integer array of shape (M, T2) of reference captions
+  - reference_owners: Integer array of shape (M,) in the range [0, N) giving
+    the candidate that each reference caption belongs to
+  - word_to_idx: Dictionary mapping words to indices
+  - max_n: Largest n-gram size; BLEU uses the geometric mean of the clipped
+    n-gram precisions for n = 1, ..., max_n
+
+  Returns:
+  - bleu: Scalar BLEU score between 0 and 1
+  """
+  N = candidates.shape[0]
+  reference_owners = np.asarray(reference_owners)
+  cand, cand_len = _strip_captions(np.asarray(candidates), word_to_idx)
+  ref, ref_len = _strip_captions(np.asarray(references), word_to_idx)
+  base = max(cand.max() if cand.size else 0, ref.max() if ref.size else 0) + 1
+  if max(N, ref.shape[0]) * float(base) ** max_n >= 2 ** 63:
+    raise ValueError('Vocabulary too large to encode %d-grams' % max_n)
+
+  log_precision = 0.0
+  for n in xrange(1, max_n + 1):
+    # Count the n-grams of each candidate
+    cand_keys, cand_counts = np.unique(
+        _ngram_keys(cand, cand_len, np.arange(N), n, base), return_counts=True)
+    total = cand_counts.sum()
+    if total == 0:
+      return 0.0
+
+    # For each candidate and n-gram, find the largest count of that n-gram
+    # in any one of the references of the candidate.
+    ref_keys, ref_counts = np.unique(
+        _ngram_keys(ref, ref_len, np.arange(ref.shape[0]), n, base),
+        return_counts=True)
+    owners = reference_owners[ref_keys // base ** n]
+    ref_keys = owners * base ** n + ref_keys % base ** n
+    order = np.argsort(ref_keys, kind='mergesort')
+    max_keys, starts = np.unique(ref_keys[order], return_index=True)
+    if max_keys.shape[0] > 0:
+      max_counts = np.maximum.reduceat(ref_counts[order], starts)
+    else:
+      max_counts = np.zeros(0, dtype=np.int64)
+
+    # Clip the candidate counts by the reference counts
+    idx = np.minimum(np.searchsorted(max_keys, cand_keys),
+                     max(max_keys.shape[0] - 1, 0))
+    if max_keys.shape[0] > 0:
+      found = max_keys[idx] == cand_keys
+      clipped = np.where(found, np.minimum(cand_counts, max_counts[idx]), 0)
+    else:
+      clipped = np.zeros_like(cand_counts)
+    if clipped.sum() == 0:
+      return 0.0
+    log_precision += np.log(clipped.sum() / float(total)) / max_n
+
+  # The effective reference length of each candidate is the length of its
+  # closest reference, preferring the shorter one on ties.
+  diff = np.abs(ref_len - cand_len[reference_owners])
+  order = np.lexsort((ref_len, diff, reference_owners))
+  owners, first = np.unique(reference_owners[order], return_index=True)
+  closest = np.zeros(N, dtype=np.int64)
+  closest[owners] = ref_len[order][first]
+  c, r = cand_len.sum(), closest.sum()
+  brevity_penalty = 1.0 if c > r else np.exp(1 - r / float(max(c, 1)))
+  return float(brevity_penalty * np.exp(log_precision))
+
+
+def caption_lengths(captions, null_idx=0):
+  """
+  Compute the true length of each caption, counting the <START> and <END>
+  tokens but not the <NULL> padding at the end.
+
+  Inputs:
+  - captions: Integer array of shape (N, T)
+  - null_idx: Index of the <NULL> token
+
+  Returns:
+  - lengths: Integer array of shape (N,)
+  """
+  return np.sum(captions != null_idx, axis=1)
+
+
+def _length_buckets(data, split):
+  """
+  Group the captions of a split by their true length. The result is computed
+  once and stored in data under the key '<split>_length_buckets' as a tuple
+  (order, starts, counts): order lists caption indices sorted by length, and
+  the captions of the ith bucket are order[starts[i]:starts[i] + counts[i]].
+  """
+  key = '%s_length_buckets' % split
+  if key not in data:
+    null_idx = data['word_to_idx']['<NULL>']
+    lengths = caption_lengths(data['%s_captions' % split], null_idx)
+    order = np.argsort(lengths, kind='mergesort')
+    _, starts, counts = np.unique(lengths[order], return_index=True,
+                                  return_counts=True)
+    data[key] = (order, starts, counts)
+  return data[key]
+
+
+class EpochSampler(object):
+  """
+  Samples minibatches of caption indices without replacement: once per epoch
+  the captions of a split are shuffled, and the epoch then walks through
+  contiguous batch_size slices of the permutation, so every caption is seen
+  exactly once per epoch. The last minibatch of an epoch may be smaller.
+
+  If sort_window is given, the permutation is sorted within consecutive
+  windows of sort_window indices. Each minibatch then reads rows in
+  increasing order, and with windows larger than the minibatch it reads from
+  a narrower range of rows, which is friendlier to caches and to memory
+  mapped data; the order of the windows is still random.
+
+  If bucket_by_length is True, the captions of each length are shuffled and
+  cut into minibatches separately and the order of all of these minibatches
+  is then shuffled, so that every minibatch holds captions of a single true
+  length as for sample_coco_minibatch.
+
+  The sampler shuffles with its own random state, seeded from the global
+  numpy random state when it is constructed. The minibatches are therefore
+  the same whether they are drawn in the main thread or by a
+  MinibatchPrefetcher, and other users of np.random do not change them.
+
+  Example usage:
+
+  sampler = EpochSampler(data, batch_size=100)
+  captions, features, urls = sample_coco_minibatch(data, sampler=sampler)
+  """
+
+  def __init__(self, data, batch_size=100, split='train',
+               bucket_by_length=False, sort_window=None):
+    if sort_window is not None and sort_window < 1:
+      raise ValueError('sort_window must be positive, got %d' % sort_window)
+    self.batch_size = batch_size
+    self.bucket_by_length = bucket_by_length
+    self.sort_window = sort_window
+    if bucket_by_length:
+      order, starts, counts = _length_buckets(data, split)
+      self._groups = [order[start:start + count]
+                      for start, count in zip(starts, counts)]
+    else:
+      self._groups = [np.arange(data['%s_captions' % split].shape[0])]
+    self.num_batches = sum((len(g) + batch_size - 1) / batch_size
+                           for g in self._groups)
+
+    self.epoch = 0
+    self._batches = []
+    self._next = 0
+    self._rng = np.random.RandomState(np.random.randint(2 ** 31))
+
+
+  def _shuffle(self, idxs):
+    idxs = idxs[self._rng.permutation(len(idxs))]
+    if self.sort_window is not None:
+      for start in xrange(0, len(idxs), self.sort_window):
+        idxs[start:start + self.sort_window].sort()
+    return idxs
+
+
+  def _new_epoch(self):
+    batches = []
+    for group in self._groups:
+      perm = self._shuffle(group)
+      for start in xrange(0, len(perm), self.batch_size):
+        batches.append(perm[start:start + self.batch_size])
+    if len(self._groups) > 1:
+      batches = [batches[i] for i in self._rng.permutation(len(batches))]
+    self._batches = batches
+    self._next = 0
+
+
+  def sample(self):
+    """
+    Return the caption indices of the next minibatch, starting a new epoch
+    when the current one is used up.
+    """
+    if self._next == len(self._batches):
+      if len(self._batches) > 0:
+        self.epoch += 1
+      self._new_epoch()
+    mask = self._batches[self._next]
+    self._next += 1
+    return mask
+
+
+def _sample_minibatch_mask(data, batch_size, split, bucket_by_length,
+                           sampler=None, rng=np.random):
+  """
+  Pick the caption indices of a minibatch; see sample_coco_minibatch. Random
+  numbers come from rng, which defaults to the global numpy random state.
+  """
+  if sampler is not None:
+    mask = sampler.sample()
+  elif bucket_by_length:
+    order, starts, counts = _length_buckets(data, split)
+    bucket = rng.choice(len(counts), p=counts / float(counts.sum()))
+    mask = order[starts[bucket] + rng.randint(counts[bucket], size=batch_size)]
+  else:
+    split_size = data['%s_captions' % split].shape[0]
+    mask = rng.choice(split_size, batch_size)
+  return mask
+
+
+def sample_coco_minibatch(data, batch_size=100, split='train',
+                          bucket_by_length=False, sampler=None):
+  """
+  Sample a minibatch of captions, image features and image urls.
+
+  If bucket_by_length is True, all captions of the minibatch have the same
+  true length: we pick a length with probability proportional to the number of
+  captions of that length, sample captions of that length, and trim the
+  <NULL> padding columns from the end. Most captions are much shorter than the
+  padded length, so this saves a lot of work in the RNN and the softmax.
+
+  By default captions are sampled independently with replacement. Pass an
+  EpochSampler as sampler to walk through the split without replacement
+  instead; the minibatch size and bucketing then come from the sampler.
+  """
+  if sampler is not None:
+    bucket_by_length = sampler.bucket_by_length
+  mask = _sample_minibatch_mask(data, batch_size, split, bucket_by_length,
+                                sampler)
   captions = data['%s_captions' % split][mask]
+  if bucket_by_length:
+    null_idx = data['word_to_idx']['<NULL>']
+    length = max(caption_lengths(captions[:1], null_idx)[0], 2)
+    captions = captions[:, :length]
   image_idxs = data['%s_image_idxs' % split][mask]
   image_features = data['%s_features' % split][image_idxs]
   urls = data['%s_urls' % split][image_idxs]
   return captions, image_features, urls
 
+
+def _gather_rows(source, idxs, out):
+  """
+  Copy the rows source[idxs] into the preallocated array out.
+  """
+  if isinstance(source, np.ndarray):
+    # The sampled indices are always in range; mode='clip' lets take write
+    # straight into out instead of going through a temporary.
+    np.take(source, idxs, axis=0, out=out, mode='clip')
+  else:
+    out[...] = source[idxs]
+  return out
+
+
+class MinibatchPrefetcher(object):
+  """
+  Prepares minibatches in a background thread while the model computes.
+
+  The producer thread samples minibatches exactly like sample_coco_minibatch
+  and gathers their captions and features into a small pool of preallocated
+  buffers, keeping up to num_prefetch finished minibatches in a bounded
+  queue. The arrays returned by get() live in one of these buffers and stay
+  valid until the next call to get(), after which the buffer is reused; copy
+  them if you need to keep them around.
+
+  The prefetcher counts the time get() spends waiting for the producer in
+  stall_time (and the number of such waits in num_stalls); if this grows with
+  training time, training is input-bound.
+
+  Example usage:
+
+  prefetcher = MinibatchPrefetcher(data, batch_size=100, num_prefetch=4)
+  prefetcher.start()
+  captions, features, urls = prefetcher.get()
+  ...
+  prefetcher.stop()
+  print prefetcher.stall_time
+  """
+
+  def __init__(self, data, batch_size=100, split='train',
+               bucket_by_length=False, num_prefetch=2, sampler=None):
+    if num_prefetch < 1:
+      raise ValueError('num_prefetch must be at least 1, got %d' % num_prefetch)
+    self.data = data
+    self.batch_size = batch_size
+    self.split = split
+    self.bucket_by_length = bucket_by_length
+    self.num_prefetch = num_prefetch
+    self.sampler = sampler
+    if sampler is not None:
+      self.batch_size = batch_size = sampler.batch_size
+      self.bucket_by_length = sampler.bucket_by_length
+    self.stall_time = 0.0
+    self.num_stalls = 0
+
+    # The producer thread samples with its own random state, so that it does
+    # not race with the main thread for np.random and seeded training stays
+    # reproducible. With a sampler the sampler's random state is used instead.
+    self._rng = None
+    if sampler is None:
+      self._rng = np.random.RandomState(np.random.randint(2 ** 31))
+
+    # One buffer per queued minibatch, plus the one being filled by the
+    # producer and the one handed out to the consumer.
+    captions = data['%s_captions' % split]
+    features = data['%s_features' % split]
+    self._buffers = []
+    for i in xrange(num_prefetch + 2):
+      self._buffers.append((
+        np.empty((batch_size,) + captions.shape[1:], dtype=captions.dtype),
+        np.empty((batch_size,) + features.shape[1:], dtype=features.dtype)))
+
+    self._free = Queue()
+    self._ready = Queue(maxsize=num_prefetch)
+    self._current = None
+    self._thread = None
+    self._error = None
+    self._stop = threading.Event()
+
+
+  def start(self):
+    """
+    Start the producer thread.
+    """
+    if self._thread is not None:
+      return
+    self._stop.clear()
+    self._free = Queue()
+    self._ready = Queue(maxsize=self.num_prefetch)
+    for i in xrange(len(self._buffers)):
+      self._free.put(i)
+    self._current = None
+    self._thread = threading.Thread(target=self._produce)
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def stop(self):
+    """
+    Stop the producer thread and drop any prefetched minibatches.
+    """
+    if self._thread is None:
+      return
+    self._stop.set()
+    self._thread.join()
+    self._thread = None
+
+
+  def get(self):
+    """
+    Return the next minibatch as a tuple (captions, features, urls), in the
+    same format as sample_coco_minibatch.
+    """
+    if self._thread is None:
+      raise ValueError('MinibatchPrefetcher has not been started')
+    if self._current is not None:
+      self._free.put(self._current)
+      self._current = None
+
+    try:
+      item = self._ready.get_nowait()
+    except Empty:
+      tic = time.time()
+      while True:
+        try:
+          item = self._ready.get(timeout=0.1)
+          break
+        except Empty:
+          if self._error is not None:
+            raise self._error
+      self.stall_time += time.time() - tic
+      self.num_stalls += 1
+
+    i, n, length, urls = item
+    self._current = i
+    captions, features = self._buffers[i]
+    captions, features = captions[:n], features[:n]
+    if length is not None:
+      captions = captions[:, :length]
+    return captions, features, urls
+
+
+  def _produce(self):
+    """
+    Body of the producer thread.
+    """
+    data, split = self.data, self.split
+    try:
+      while not self._stop.is_set():
+        try:
+          i = self._free.get(timeout=0.1)
+        except Empty:
+          continue
+        captions, features = self._buffers[i]
+        mask = _sample_minibatch_mask(data, self.batch_size, split,
+                                      self.bucket_by_length, self.sampler,
+                                      self._rng)
+        n = mask.shape[0]
+        captions, features = captions[:n], features[:n]
+        _gather_rows(data['%s_captions' % split], mask, captions)
+        length = None
+        if self.bucket_by_length:
+          null_idx = data['word_to_idx']['<NULL>']
+          length = max(caption_lengths(captions[:1], null_idx)[0], 2)
+        image_idxs = data['%s_image_idxs' % split][mask]
+        _gather_rows(data['%s_features' % split], image_idxs, features)
+        urls = data['%s_urls' % split][image_idxs]
+
+        item = (i, n, length, urls)
+        while not self._stop.is_set():
+          try:
+            self._ready.put(item, timeout=0.1)
+            break
+          except Full:
+            pass
+    except Exception as e:
+      self._error = e
@@ -1,7 +1,8 @@
+import json, os, time
 import numpy as np
 try:
   from cs231n.im2col_cython import col2im_cython, im2col_cython
-  from cs231n.im2col_cython import col2im_6d_cython
+  from cs231n.im2col_cython import col2im_6d_cython, im2col_6d_cython
 except ImportError:
   print 'run the following from the cs231n directory and try again:'
   print 'python setup.py build_ext --inplace'
@@ -48,24 +49,23 @@ def conv_forward_strides(x, w, b, conv_param):
   #assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
   #assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
 
-  # Pad the input
-  p = pad
-  x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-  
   # Figure out output dimensions
-  H += 2 * pad
-  W += 2 * pad
-  out_h = (H - HH) / stride + 1
-  out_w = (W - WW) / stride + 1
-
-  # Perform an im2col operation by picking clever strides
-  shape = (C, HH, WW, N, out_h, out_w)
-  strides = (H * W, W, 1, C * H * W, stride * W, stride)
-  strides = x.itemsize * np.array(strides)
-  x_stride = np.lib.stride_tricks.as_strided(x_padded,
-                shape=shape, strides=strides)
-  x_cols = np.ascontiguousarray(x_stride)
-  x_cols.shape = (C * HH * WW, N * out_h * out_w)
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+
+  if pad > 0:
+    # Build the columns straight from x; the kernel reads taps that fall
+    # into the padding as zeros, so no padded copy of x is needed.
+    x_cols = im2col_6d_cython(x, HH, WW, pad, stride)
+  else:
+    # Perform an im2col operation by picking clever strides
+    shape = (C, HH, WW, N, out_h, out_w)
+    strides = (H * W, W, 1, C * H * W, stride * W, stride)
+    strides = x.itemsize * np.array(strides)
+    x_stride = np.lib.stride_tricks.as_strided(np.ascontiguousarray(x),
+                  shape=shape, strides=strides)
+    x_cols = np.ascontiguousarray(x_stride)
+    x_cols.shape = (C * HH * WW, N * out_h * out_w)
 
   # Now all our convolutions are a big matrix multiply
   res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
@@ -125,8 +125,520 @@ def conv_backward_im2col(dout, cache):
   return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+def conv_forward_direct(x, w, b, conv_param):
+  """
+  A direct implementation of the forward pass for a convolutional layer: for
+  every filter tap (hh, ww) the strided slice of the input it sees is
+  multiplied with w[:, :, hh, ww] and added to the output. There is no im2col
+  buffer, which makes this a good choice for small filters, and 1x1 filters
+  in particular, where it is a single matrix multiply.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  out_h = (H + 2 * pad - HH) / stride + 1
+  out_w = (W + 2 * pad - WW) / stride + 1
+
+  p = pad
+  x_padded = x
+  if pad > 0:
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+
+  # Accumulate into an (F, N, out_h, out_w) array so every tap is one GEMM
+  out = np.zeros((F, N, out_h, out_w), dtype=np.result_type(x, w))
+  for hh in xrange(HH):
+    for ww in xrange(WW):
+      x_tap = x_padded[:, :, hh:hh + stride * out_h:stride,
+                       ww:ww + stride * out_w:stride]
+      out += np.tensordot(w[:, :, hh, ww], x_tap, axes=([1], [1]))
+  out += b.reshape(-1, 1, 1, 1)
+  out = np.ascontiguousarray(out.transpose(1, 0, 2, 3))
+
+  cache = (x_padded, w, b, conv_param, x.shape)
+  return out, cache
+
+
+def conv_backward_direct(dout, cache):
+  """
+  The backward pass for conv_forward_direct.
+  """
+  x_padded, w, b, conv_param, x_shape = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, H, W = x_shape
+  F, _, HH, WW = w.shape
+  _, _, out_h, out_w = dout.shape
+
+  db = np.sum(dout, axis=(0, 2, 3))
+  dw = np.empty_like(w)
+  dx_padded = np.zeros(x_padded.shape, dtype=dout.dtype)
+  for hh in xrange(HH):
+    for ww in xrange(WW):
+      rows = slice(hh, hh + stride * out_h, stride)
+      cols = slice(ww, ww + stride * out_w, stride)
+      x_tap = x_padded[:, :, rows, cols]
+      dw[:, :, hh, ww] = np.tensordot(dout, x_tap, axes=([0, 2, 3], [0, 2, 3]))
+      dx_tap = np.tensordot(w[:, :, hh, ww], dout, axes=([0], [1]))
+      dx_padded[:, :, rows, cols] += dx_tap.transpose(1, 0, 2, 3)
+
+  dx = dx_padded
+  if pad > 0:
+    dx = np.ascontiguousarray(dx_padded[:, :, pad:pad + H, pad:pad + W])
+  return dx, dw, db
+
+
+# Transforms of the filters (Winograd transforms, FFT spectra), keyed by the
+# transform, id(w) and any extra arguments. The weights are updated in place
+# during training, so each entry keeps a copy of the weights it was computed
+# from and is only reused while they are unchanged.
+_filter_transform_cache = {}
+_filter_transform_cache_size = 32
+
+
+def _cached_filter_transform(transform, w, *args):
+  """
+  Return transform(w, *args), reusing the cached result if w has not changed.
+  """
+  key = (transform.__name__, id(w)) + args
+  entry = _filter_transform_cache.get(key)
+  if entry is not None and entry[0].dtype == w.dtype and np.array_equal(entry[0], w):
+    return entry[1]
+  result = transform(w, *args)
+  if len(_filter_transform_cache) >= _filter_transform_cache_size:
+    _filter_transform_cache.clear()
+  _filter_transform_cache[key] = (w.copy(), result)
+  return result
+
+
+"""
+Winograd F(2x2, 3x3) convolution for 3x3 filters with stride 1 (Lavin and
+Gray, "Fast Algorithms for Convolutional Neural Networks"). The padded input
+is cut into overlapping 4x4 tiles that each produce a 2x2 block of outputs.
+In the transformed domain the convolution becomes 16 independent matrix
+multiplies over channels. These use 16 multiplies per 2x2 block of outputs
+instead of the 36 used by a direct or im2col convolution.
+
+With d a 4x4 input tile and g a 3x3 filter, the output tile is
+A^T [(G g G^T) * (B^T d B)] A. B^T and A^T only hold 0 and +-1, so the tile
+transforms below are written out as sums of strided slices. The helpers
+apply a transform along one axis to a list of four (or two) arrays.
+"""
+_winograd_G = np.array([[1.0, 0.0, 0.0],
+                        [0.5, 0.5, 0.5],
+                        [0.5, -0.5, 0.5],
+                        [0.0, 0.0, 1.0]])
+
+
+def _winograd_BT(d):
+  return [d[0] - d[2], d[1] + d[2], d[2] - d[1], d[1] - d[3]]
+
+
+def _winograd_B(d):
+  return [d[0], d[1] - d[2] + d[3], d[1] + d[2] - d[0], -d[3]]
+
+
+def _winograd_AT(m):
+  return [m[0] + m[1] + m[2], m[1] - m[2] - m[3]]
+
+
+def _winograd_A(y):
+  return [y[0], y[0] + y[1], y[0] - y[1], -y[1]]
+
+
+def _winograd_filter_transform(w):
+  """
+  Return U of shape (16, F, C), the transform G w G^T of every 3x3 filter.
+  """
+  F, C, _, _ = w.shape
+  G = _winograd_G.astype(w.dtype)
+  U = np.dot(np.dot(G, w), G.T)
+  return np.ascontiguousarray(U.transpose(0, 3, 1, 2)).reshape(16, F, C)
+
+
+def _batched_dot(a, b):
+  """
+  Multiply a[k] and b[k] for every k; a has shape (K, n, m), b (K, m, p).
+  """
+  out = np.empty((a.shape[0], a.shape[1], b.shape[2]),
+                 dtype=np.result_type(a, b))
+  for k in xrange(a.shape[0]):
+    np.dot(a[k], b[k], out=out[k])
+  return out
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+  """
+  A Winograd F(2x2, 3x3) implementation of the forward pass for a
+  convolutional layer with 3x3 filters and stride 1.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  if HH != 3 or WW != 3 or stride != 1:
+    raise ValueError('Winograd convolution needs 3x3 filters with stride 1')
+  out_h = H + 2 * pad - 2
+  out_w = W + 2 * pad - 2
+  tiles_h = (out_h + 1) / 2
+  tiles_w = (out_w + 1) / 2
+
+  # Pad so that the tiles cover the input exactly; an odd output size gets
+  # one extra row or column of zeros that is cropped off at the end.
+  x_padded = np.pad(x, ((0, 0), (0, 0),
+                        (pad, 2 * tiles_h + 2 - H - pad),
+                        (pad, 2 * tiles_w + 2 - W - pad)), mode='constant')
+  x_padded = x_padded.transpose(1, 0, 2, 3)
+
+  # Input transform V = B^T d B for every tile, laid out as (16, C, tiles)
+  V = np.empty((4, 4, C, N, tiles_h, tiles_w), dtype=x.dtype)
+  rows = _winograd_BT([x_padded[:, :, k:k + 2 * tiles_h:2] for k in xrange(4)])
+  for i in xrange(4):
+    cols = _winograd_BT([rows[i][:, :, :, k:k + 2 * tiles_w:2]
+                         for k in xrange(4)])
+    for j in xrange(4):
+      V[i, j] = cols[j]
+  V = V.reshape(16, C, N * tiles_h * tiles_w)
+
+  U = _cached_filter_transform(_winograd_filter_transform, w)
+  M = _batched_dot(U, V).reshape(4, 4, F, N, tiles_h, tiles_w)
+
+  # Output transform Y = A^T M A, written straight into 2x2 output blocks
+  Y = np.empty((F, N, tiles_h, 2, tiles_w, 2), dtype=M.dtype)
+  rows = _winograd_AT(M)
+  for p in xrange(2):
+    cols = _winograd_AT(rows[p])
+    for q in xrange(2):
+      Y[:, :, :, p, :, q] = cols[q]
+  Y = Y.reshape(F, N, 2 * tiles_h, 2 * tiles_w)
+  # Add the bias while swapping to (N, F) order so out is C-contiguous
+  out = np.empty((N, F, out_h, out_w), dtype=Y.dtype)
+  np.add(Y[:, :, :out_h, :out_w].transpose(1, 0, 2, 3), b.reshape(1, -1, 1, 1),
+         out=out)
+
+  cache = (x.shape, w, b, conv_param, U, V)
+  return out, cache
+
+
+def conv_backward_winograd(dout, cache):
+  """
+  The backward pass for conv_forward_winograd.
+  """
+  x_shape, w, b, conv_param, U, V = cache
+  N, C, H, W = x_shape
+  F = w.shape[0]
+  pad = conv_param['pad']
+  _, _, out_h, out_w = dout.shape
+  tiles_h = (out_h + 1) / 2
+  tiles_w = (out_w + 1) / 2
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  # Y = A^T M A for every tile, so dM = A dY A^T
+  dY = np.zeros((F, N, 2 * tiles_h, 2 * tiles_w), dtype=dout.dtype)
+  dY[:, :, :out_h, :out_w] = dout.transpose(1, 0, 2, 3)
+  dM = np.empty((4, 4, F, N, tiles_h, tiles_w), dtype=dout.dtype)
+  rows = _winograd_A([dY[:, :, p::2] for p in xrange(2)])
+  for i in xrange(4):
+    cols = _winograd_A([rows[i][:, :, :, q::2] for q in xrange(2)])
+    for j in xrange(4):
+      dM[i, j] = cols[j]
+  dM = dM.reshape(16, F, N * tiles_h * tiles_w)
+
+  # U = G w G^T, so dw = G^T dU G
+  dU = _batched_dot(dM, V.transpose(0, 2, 1)).reshape(4, 4, F, C)
+  G = _winograd_G.astype(dout.dtype)
+  dw = np.tensordot(np.tensordot(G, dU, axes=([0], [0])), G, axes=([1], [0]))
+  dw = np.ascontiguousarray(dw.transpose(1, 2, 0, 3))
+
+  # V = B^T d B, so dd = B dV B^T; the tiles overlap, so every tile is added
+  # into the padded dx through strided slices.
+  dV = _batched_dot(U.transpose(0, 2, 1), dM)
+  dV = dV.reshape(4, 4, C, N, tiles_h, tiles_w)
+  dx_padded = np.zeros((C, N, 2 * tiles_h + 2, 2 * tiles_w + 2),
+                       dtype=dout.dtype)
+  rows = [_winograd_B(dV[i]) for i in xrange(4)]
+  for l in xrange(4):
+    cols = _winograd_B([rows[i][l] for i in xrange(4)])
+    for k in xrange(4):
+      dx_padded[:, :, k:k + 2 * tiles_h:2, l:l + 2 * tiles_w:2] += cols[k]
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W].transpose(1, 0, 2, 3)
+  dx = np.ascontiguousarray(dx)
+
+  return dx, dw, db
+
+
+def _winograd_supported(x_shape, w_shape, conv_param):
+  return w_shape[2:] == (3, 3) and conv_param['stride'] == 1
+
+
+"""
+FFT convolution. Every (image, filter) pair is correlated in the frequency
+domain with rfft2, so the cost does not grow with the filter size and no
+im2col matrix is built; the extra memory is the spectra of the inputs and
+filters. This pays off for large images and large filters, such as blurring
+full-size images in image_utils. Strided layers compute the full stride-1
+output and keep every stride-th value.
+"""
+
+
+def _fft_size(n):
+  """
+  Smallest integer >= n with no prime factors other than 2, 3 and 5; FFTs
+  of these sizes are much faster than of sizes with large prime factors.
+  """
+  while True:
+    m = n
+    for p in (2, 3, 5):
+      while m % p == 0:
+        m /= p
+    if m == 1:
+      return n
+    n += 1
+
+
+def _fft_filter_spectrum(w, fft_h, fft_w):
+  """
+  Return the complex conjugate of the spectrum of every filter, of shape
+  (F, C, fft_h, fft_w / 2 + 1); multiplying by it correlates with w.
+  """
+  return np.conj(np.fft.rfft2(w, s=(fft_h, fft_w)))
+
+
+def conv_forward_fft(x, w, b, conv_param):
+  """
+  An FFT-based implementation of the forward pass for a convolutional layer.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  H_padded, W_padded = H + 2 * pad, W + 2 * pad
+  out_h = (H_padded - HH) / stride + 1
+  out_w = (W_padded - WW) / stride + 1
+
+  # The correlation is circular, but the outputs we keep never wrap around
+  # as long as the FFT is at least as large as the padded input.
+  fft_h, fft_w = _fft_size(H_padded), _fft_size(W_padded)
+  x_padded = x
+  if pad > 0:
+    x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                      mode='constant')
+  x_spectrum = np.fft.rfft2(x_padded, s=(fft_h, fft_w))
+  w_spectrum = _cached_filter_transform(_fft_filter_spectrum, w, fft_h, fft_w)
+
+  out_spectrum = np.einsum('nchw,fchw->nfhw', x_spectrum, w_spectrum)
+  out = np.fft.irfft2(out_spectrum, s=(fft_h, fft_w))
+  out = out[:, :, :stride * out_h:stride, :stride * out_w:stride]
+  out = (out + b.reshape(1, -1, 1, 1)).astype(np.result_type(x, w))
+
+  cache = (x.shape, w, b, conv_param, x_spectrum)
+  return out, cache
+
+
+def conv_backward_fft(dout, cache):
+  """
+  The backward pass for conv_forward_fft.
+  """
+  x_shape, w, b, conv_param, x_spectrum = cache
+  N, C, H, W = x_shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  H_padded, W_padded = H + 2 * pad, W + 2 * pad
+  fft_h, fft_w = _fft_size(H_padded), _fft_size(W_padded)
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  # Spread a strided upstream gradient back onto the stride-1 output grid
+  dout_full = dout
+  if stride > 1:
+    dout_full = np.zeros((N, F, H_padded - HH + 1, W_padded - WW + 1),
+                         dtype=dout.dtype)
+    dout_full[:, :, :stride * dout.shape[2]:stride,
+              :stride * dout.shape[3]:stride] = dout
+  dout_spectrum = np.fft.rfft2(dout_full, s=(fft_h, fft_w))
+
+  # dw is the correlation of the padded input with dout
+  dw_spectrum = np.einsum('nfhw,nchw->fchw', np.conj(dout_spectrum), x_spectrum)
+  dw = np.fft.irfft2(dw_spectrum, s=(fft_h, fft_w))[:, :, :HH, :WW]
+
+  # dx is the full convolution of dout with the filters
+  w_spectrum = _cached_filter_transform(_fft_filter_spectrum, w, fft_h, fft_w)
+  dx_spectrum = np.einsum('nfhw,fchw->nchw', dout_spectrum, np.conj(w_spectrum))
+  dx = np.fft.irfft2(dx_spectrum, s=(fft_h, fft_w))
+  dx = dx[:, :, pad:pad + H, pad:pad + W]
+
+  dtype = np.result_type(dout, w)
+  return dx.astype(dtype), dw.astype(dtype), db
+
+
+def _im2col_supported(x_shape, w_shape, conv_param):
+  H, W = x_shape[2:]
+  HH, WW = w_shape[2:]
+  stride, pad = conv_param['stride'], conv_param['pad']
+  return (H + 2 * pad - HH) % stride == 0 and (W + 2 * pad - WW) % stride == 0
+
+
+"""
+Registry of convolution algorithms. Each entry maps a name to a tuple
+(forward, backward, supported), where forward and backward have the same
+interface as conv_forward_strides and conv_backward_strides, and
+supported(x_shape, w_shape, conv_param) says whether the algorithm can handle
+a layer; None means it handles everything.
+"""
+conv_algorithms = {}
+
+
+def register_conv_algorithm(name, forward, backward, supported=None):
+  """
+  Add a convolution algorithm to the registry so that conv_forward_fast can
+  pick it.
+  """
+  conv_algorithms[name] = (forward, backward, supported)
+
+
+register_conv_algorithm('strides', conv_forward_strides, conv_backward_strides)
+register_conv_algorithm('im2col', conv_forward_im2col, conv_backward_im2col,
+                        _im2col_supported)
+register_conv_algorithm('direct', conv_forward_direct, conv_backward_direct)
+register_conv_algorithm('winograd', conv_forward_winograd,
+                        conv_backward_winograd, _winograd_supported)
+register_conv_algorithm('fft', conv_forward_fft, conv_backward_fft)
+
+
+"""
+Autotuning. The first time conv_forward_fast sees a layer configuration it
+times the forward and backward pass of every algorithm that supports it and
+remembers the fastest one. These plans are saved as JSON to the file named by
+the CS231N_CONV_PLANS environment variable (by default
+~/.cs231n/conv_plans.json), so later runs skip the benchmark. Set
+conv_autotune = False to always use default_conv_algorithm instead.
+"""
+conv_autotune = True
+default_conv_algorithm = 'strides'
+_conv_plans = None
+
+
+def _conv_plans_file():
+  default = os.path.join(os.path.expanduser('~'), '.cs231n', 'conv_plans.json')
+  return os.environ.get('CS231N_CONV_PLANS', default)
+
+
+def _load_conv_plans():
+  global _conv_plans
+  if _conv_plans is None:
+    _conv_plans = {}
+    try:
+      with open(_conv_plans_file(), 'r') as f:
+        _conv_plans = json.load(f)
+    except (IOError, ValueError):
+      pass
+  return _conv_plans
+
+
+def _save_conv_plans():
+  # Write to a temporary file first so that a crash or a concurrent run never
+  # leaves a truncated plan file behind.
+  filename = _conv_plans_file()
+  try:
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+      json.dump(_conv_plans, f, indent=1, sort_keys=True)
+    os.rename(tmp_filename, filename)
+  except (IOError, OSError):
+    pass
+
+
+def conv_plan_key(x_shape, w_shape, conv_param, dtype):
+  """
+  The key under which the plan for a layer configuration is stored.
+  """
+  return '%s|%s|stride=%d|pad=%d|%s' % (
+      'x'.join(map(str, x_shape)), 'x'.join(map(str, w_shape)),
+      conv_param['stride'], conv_param['pad'], np.dtype(dtype).name)
+
+
+def tune_conv(x_shape, w_shape, conv_param, dtype, num_trials=2):
+  """
+  Time the forward and backward pass of every registered algorithm that
+  supports a layer configuration on random data, and return the name of the
+  fastest. Algorithms that fail (for example because the Cython extension is
+  not built) are skipped.
+  """
+  # Use a private random state, so that whether a plan is already cached does
+  # not change the random numbers seen by the caller.
+  rng = np.random.RandomState(0)
+  x = rng.randn(*x_shape).astype(dtype)
+  w = rng.randn(*w_shape).astype(dtype)
+  b = rng.randn(w_shape[0]).astype(dtype)
+  best_name, best_time = default_conv_algorithm, float('inf')
+  for name in sorted(conv_algorithms):
+    forward, backward, supported = conv_algorithms[name]
+    if supported is not None and not supported(x_shape, w_shape, conv_param):
+      continue
+    try:
+      elapsed = float('inf')
+      for t in xrange(num_trials):
+        tic = time.time()
+        out, cache = forward(x, w, b, conv_param)
+        backward(out, cache)
+        elapsed = min(elapsed, time.time() - tic)
+    except Exception:
+      continue
+    if elapsed < best_time:
+      best_name, best_time = name, elapsed
+  return best_name
+
+
+def choose_conv_algorithm(x, w, conv_param):
+  """
+  Return the name of the algorithm that conv_forward_fast uses for a layer:
+  the one named by conv_param['algorithm'] if given (other than 'auto'),
+  else the autotuned plan for the layer configuration.
+  """
+  name = conv_param.get('algorithm', 'auto')
+  if name != 'auto':
+    if name not in conv_algorithms:
+      raise ValueError('Unrecognized conv algorithm "%s"' % name)
+    return name
+  if not conv_autotune:
+    return default_conv_algorithm
+
+  plans = _load_conv_plans()
+  key = conv_plan_key(x.shape, w.shape, conv_param, x.dtype)
+  name = plans.get(key)
+  if name not in conv_algorithms:
+    name = tune_conv(x.shape, w.shape, conv_param, x.dtype)
+    plans[key] = name
+    _save_conv_plans()
+  return name
+
+
+def conv_forward_fast(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer.
+
+  This dispatches to one of the registered conv_algorithms: the one chosen by
+  conv_param['algorithm'] if present, otherwise the fastest one for this
+  layer configuration as found by the autotuner. The built-in algorithms are
+  'strides', 'im2col', 'direct', 'winograd' and 'fft'; for example,
+  conv_param = {'stride': 1, 'pad': 5, 'algorithm': 'fft'} convolves large
+  images with 11x11 filters without building an im2col matrix.
+  """
+  name = choose_conv_algorithm(x, w, conv_param)
+  out, real_cache = conv_algorithms[name][0](x, w, b, conv_param)
+  cache = (name, real_cache)
+  return out, cache
+
+
+def conv_backward_fast(dout, cache):
+  """
+  A fast implementation of the backward pass for a convolutional layer,
+  using the algorithm that produced the cache.
+  """
+  name, real_cache = cache
+  if name not in conv_algorithms:
+    raise ValueError('Unrecognized conv algorithm "%s"' % name)
+  return conv_algorithms[name][1](dout, real_cache)
 
 
 def max_pool_forward_fast(x, pool_param):
@@ -1,6 +1,7 @@
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel import prange
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,113 +10,241 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
+# The inner loops below run in parallel with OpenMP (see setup.py); the number
+# of threads is set with the OMP_NUM_THREADS environment variable. Each loop is
+# partitioned so that no two threads ever write to the same element, so no
+# atomics or locks are needed.
+#
+# None of the kernels allocates a padded copy of its input or output: taps that
+# fall into the zero padding read as zero in im2col and are skipped in col2im.
+
 def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
                   int field_width, int padding, int stride):
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
+
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
 
-    cdef int p = padding
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
-            ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
+    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.empty(
             (C * field_height * field_width, N * HH * WW),
             dtype=x.dtype)
 
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
-
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
+    cdef DTYPE_t[:, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = np.ascontiguousarray(x)
+    im2col_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                             DTYPE_t[:, :, :, ::1] x,
                              int N, int C, int H, int W, int HH, int WW,
                              int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+    cdef int c, ii, jj, row, yy, xx, i, y, z
+    cdef int K = field_height * field_width
+    cdef Py_ssize_t image_size = C * H * W
+    cdef DTYPE_t* dst
+    cdef DTYPE_t* src
+
+    # Every row of cols belongs to one thread, and each row is written front
+    # to back: col = (yy * WW + xx) * N + i walks contiguous memory.
+    for row in prange(C * K, nogil=True, schedule='static'):
+        c = row / K
+        ii = (row % K) / field_width
+        jj = row % field_width
         for yy in range(HH):
+            y = stride * yy + ii - padding
             for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
+                z = stride * xx + jj - padding
+                dst = &cols[row, (yy * WW + xx) * N]
+                if y < 0 or y >= H or z < 0 or z >= W:
+                    for i in range(N):
+                        dst[i] = 0
+                else:
+                    src = &x[0, c, y, z]
+                    for i in range(N):
+                        dst[i] = src[i * image_size]
+    return 0
 
 
 
 def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
                   int field_height, int field_width, int padding, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
-                                        dtype=cols.dtype)
+    cdef np.ndarray[DTYPE_t, ndim=4] x = np.zeros((N, C, H, W), dtype=cols.dtype)
 
     # Moving the inner loop to a C-function with no bounds checking improves
     # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
+    cdef DTYPE_t[:, ::1] cols_view = np.ascontiguousarray(cols)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x
+    col2im_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
-    if padding > 0:
-        return x_padded[:, :, padding:-padding, padding:-padding]
-    return x_padded
+    return x
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int col2im_cython_inner(DTYPE_t[:, ::1] cols,
+                             DTYPE_t[:, :, :, ::1] x,
                              int N, int C, int H, int W, int HH, int WW,
                              int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+    cdef int c, ii, jj, row, yy, xx, i, col, nc, y, z
+
+    # Overlapping windows add into the same pixels, so split the work by
+    # image plane: the thread that owns (i, c) is the only one writing to
+    # x[i, c].
+    for nc in prange(N * C, nogil=True, schedule='static'):
+        i = nc / C
+        c = nc % C
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
+                row = (c * field_height + ii) * field_width + jj
                 for yy in range(HH):
+                    y = stride * yy + ii - padding
+                    if y < 0 or y >= H:
+                        continue
                     for xx in range(WW):
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                        z = stride * xx + jj - padding
+                        if z < 0 or z >= W:
+                            continue
+                        col = (yy * WW + xx) * N + i
+                        x[i, c, y, z] += cols[row, col]
+    return 0
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
-
-    cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
-            for hh in range(HH):
-                for ww in range(WW):
-                    for h in range(out_h):
-                        for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
+@cython.cdivision(True)
+cdef int col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, ::1] cols,
+                                DTYPE_t[:, :, :, ::1] x,
+                                int N, int C, int H, int W, int HH, int WW,
+                                int out_h, int out_w, int pad, int stride) except? -1:
+
+    cdef int c, hh, ww, n, h, w, nc, off, h_lo, h_hi, w_lo, w_hi
+    cdef DTYPE_t* dst
+    cdef DTYPE_t* src
+    # As for col2im_cython_inner, each thread owns whole image planes
+    # x[n, c]; the innermost loop reads cols contiguously. For each tap
+    # (hh, ww) the ranges of h and w are clipped to the outputs whose input
+    # pixel lies inside the image.
+    for nc in prange(N * C, nogil=True, schedule='static'):
+        n = nc / C
+        c = nc % C
+        for hh in range(HH):
+            h_lo = _first_inside(hh - pad, stride)
+            h_hi = _end_inside(hh - pad, stride, H, out_h)
+            for ww in range(WW):
+                off = ww - pad
+                w_lo = _first_inside(off, stride)
+                w_hi = _end_inside(off, stride, W, out_w)
+                for h in range(h_lo, h_hi):
+                    dst = &x[n, c, stride * h + hh - pad, 0]
+                    src = &cols[c, hh, ww, n, h, 0]
+                    for w in range(w_lo, w_hi):
+                        dst[stride * w + off] += src[w]
+    return 0
+
+
+@cython.cdivision(True)
+cdef inline int _first_inside(int offset, int stride) nogil:
+    # Smallest h >= 0 with stride * h + offset >= 0
+    if offset >= 0:
+        return 0
+    return (-offset + stride - 1) / stride
+
+
+@cython.cdivision(True)
+cdef inline int _end_inside(int offset, int stride, int size, int out_size) nogil:
+    # One past the largest h < out_size with stride * h + offset < size
+    cdef int end
+    if size - offset <= 0:
+        return 0
+    end = (size - offset - 1) / stride + 1
+    if end > out_size:
+        return out_size
+    return end
+
 
 def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
         int HH, int WW, int pad, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int out_h = (H + 2 * pad - HH) / stride + 1
     cdef int out_w = (W + 2 * pad - WW) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
-                                                  dtype=cols.dtype)
+    cdef np.ndarray[DTYPE_t, ndim=4] x = np.zeros((N, C, H, W), dtype=cols.dtype)
+
+    cdef DTYPE_t[:, :, :, :, :, ::1] cols_view = np.ascontiguousarray(cols)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x
+    col2im_6d_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                           out_h, out_w, pad, stride)
+    return x
+
+
+def im2col_6d_cython(np.ndarray[DTYPE_t, ndim=4] x, int HH, int WW, int pad,
+                     int stride):
+    """
+    im2col in the layout used by conv_forward_strides: returns an array of
+    shape (C * HH * WW, N * out_h * out_w) whose columns are ordered by
+    (n, h, w), without padding x first.
+    """
+    cdef int N = x.shape[0]
+    cdef int C = x.shape[1]
+    cdef int H = x.shape[2]
+    cdef int W = x.shape[3]
+    cdef int out_h = (H + 2 * pad - HH) / stride + 1
+    cdef int out_w = (W + 2 * pad - WW) / stride + 1
+    cdef np.ndarray[DTYPE_t, ndim=6] cols = np.empty((C, HH, WW, N, out_h, out_w),
+                                               dtype=x.dtype)
+
+    cdef DTYPE_t[:, :, :, :, :, ::1] cols_view = cols
+    cdef DTYPE_t[:, :, :, ::1] x_view = np.ascontiguousarray(x)
+    im2col_6d_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
+                           out_h, out_w, pad, stride)
+    return cols.reshape(C * HH * WW, N * out_h * out_w)
 
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
 
-    if pad > 0:
-        return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int im2col_6d_cython_inner(DTYPE_t[:, :, :, :, :, ::1] cols,
+                                DTYPE_t[:, :, :, ::1] x,
+                                int N, int C, int H, int W, int HH, int WW,
+                                int out_h, int out_w, int pad, int stride) except? -1:
+
+    cdef int c, hh, ww, n, h, w, row, y, off, w_lo, w_hi
+    cdef DTYPE_t* dst
+    cdef DTYPE_t* src
+    # Each thread fills whole rows cols[c, hh, ww] front to back. Within each
+    # output row only the taps in [w_lo, w_hi) fall inside the image; the
+    # rest, and whole output rows that fall into the padding, are zeros.
+    for row in prange(C * HH * WW, nogil=True, schedule='static'):
+        c = row / (HH * WW)
+        hh = (row / WW) % HH
+        ww = row % WW
+        off = ww - pad
+        w_lo = _first_inside(off, stride)
+        w_hi = _end_inside(off, stride, W, out_w)
+        if w_lo > w_hi:
+            w_lo = w_hi
+        for n in range(N):
+            for h in range(out_h):
+                dst = &cols[c, hh, ww, n, h, 0]
+                y = stride * h + hh - pad
+                if y < 0 or y >= H:
+                    for w in range(out_w):
+                        dst[w] = 0
+                    continue
+                src = &x[n, c, y, 0]
+                for w in range(w_lo):
+                    dst[w] = 0
+                for w in range(w_lo, w_hi):
+                    dst[w] = src[stride * w + off]
+                for w in range(w_hi, out_w):
+                    dst[w] = 0
+    return 0
@@ -27,6 +27,15 @@ for a variety of different problems.
 
 For efficiency, update rules may perform in-place updates, mutating w and
 setting next_w equal to w.
+
+The update rules named sparse_<rule> take a row-sparse gradient instead:
+dw is a tuple (ids, rows) where ids is an array of distinct row indices of w
+and rows holds the gradient for those rows; all other rows of the gradient
+are zero. A gradient that is sparse along another axis of w is given as
+(ids, rows, axis), where rows[i] is the gradient of w.take(ids[i], axis).
+These rules only touch the rows in ids, of w and of the cached state alike,
+so their cost scales with the number of rows in the gradient rather than
+with the size of w.
 """
 
 
@@ -63,23 +72,94 @@ def adam(x, dx, config=None):
   config.setdefault('beta1', 0.9)
   config.setdefault('beta2', 0.999)
   config.setdefault('epsilon', 1e-8)
-  config.setdefault('m', np.zeros_like(x))
-  config.setdefault('v', np.zeros_like(x))
+  if 'm' not in config: config['m'] = np.zeros_like(x)
+  if 'v' not in config: config['v'] = np.zeros_like(x)
   config.setdefault('t', 0)
   
   next_x = None
   beta1, beta2, eps = config['beta1'], config['beta2'], config['epsilon']
   t, m, v = config['t'], config['m'], config['v']
-  m = beta1 * m + (1 - beta1) * dx
-  v = beta2 * v + (1 - beta2) * (dx * dx)
+  # Update the moments in place, and reuse a single temporary for the rest
+  # of the step.
+  tmp = np.multiply(dx, 1 - beta1)
+  m *= beta1
+  m += tmp
+  np.multiply(dx, dx, out=tmp)
+  tmp *= 1 - beta2
+  v *= beta2
+  v += tmp
   t += 1
   alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
-  x -= alpha * (m / (np.sqrt(v) + eps))
+  np.sqrt(v, out=tmp)
+  tmp += eps
+  np.divide(m, tmp, out=tmp)
+  tmp *= alpha
+  x -= tmp
   config['t'] = t
-  config['m'] = m
-  config['v'] = v
   next_x = x
   
   return next_x, config
 
   
+
+
+def _unpack_sparse(dw):
+  """
+  Split a sparse gradient into (ids, rows, axis).
+  """
+  if len(dw) > 2:
+    return dw
+  return dw[0], dw[1], 0
+
+
+def sparse_sgd(w, dw, config=None):
+  """
+  Performs vanilla stochastic gradient descent with a row-sparse gradient.
+  This gives the same result as sgd with the dense gradient.
+
+  config format:
+  - learning_rate: Scalar learning rate.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-2)
+
+  ids, rows, axis = _unpack_sparse(dw)
+  np.rollaxis(w, axis)[ids] -= config['learning_rate'] * rows
+  return w, config
+
+
+def sparse_adam(x, dx, config=None):
+  """
+  Uses a lazy variant of the Adam update rule with a row-sparse gradient:
+  the moving averages and the weights are only updated for the rows in the
+  gradient. Rows that do not appear in a minibatch keep their moments
+  unchanged instead of decaying them towards zero, so this is not the same
+  as adam with the dense gradient, but it is a lot cheaper for large
+  embedding matrices. The bias correction uses the global iteration number.
+
+  config format: The same as for adam.
+  """
+  if config is None: config = {}
+  config.setdefault('learning_rate', 1e-3)
+  config.setdefault('beta1', 0.9)
+  config.setdefault('beta2', 0.999)
+  config.setdefault('epsilon', 1e-8)
+  if 'm' not in config: config['m'] = np.zeros_like(x)
+  if 'v' not in config: config['v'] = np.zeros_like(x)
+  config.setdefault('t', 0)
+
+  beta1, beta2, eps = config['beta1'], config['beta2'], config['epsilon']
+  t, m, v = config['t'], config['m'], config['v']
+  ids, rows, axis = _unpack_sparse(dx)
+  # Views with the sparse axis in front; writing to them updates the arrays
+  x_rows, m, v = [np.rollaxis(a, axis) for a in (x, m, v)]
+  m_rows = beta1 * m[ids] + (1 - beta1) * rows
+  v_rows = beta2 * v[ids] + (1 - beta2) * (rows * rows)
+  m[ids] = m_rows
+  v[ids] = v_rows
+  t += 1
+  alpha = config['learning_rate'] * np.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+  x_rows[ids] -= alpha * (m_rows / (np.sqrt(v_rows) + eps))
+  config['t'] = t
+
+  return x, config
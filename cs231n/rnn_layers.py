@@ -4,8 +4,38 @@ import numpy as np
 """
 This file defines layer types that are commonly used for recurrent neural
 networks.
+
+All layers allocate their outputs with the dtype of their floating point
+inputs, so a model that keeps its parameters in float32 runs in float32 end to
+end. Set check_dtypes to True to make every layer raise a TypeError as soon as
+one of its outputs is wider than its inputs; this is useful for tracking down
+silent upcasts to float64.
 """
 
+check_dtypes = False
+
+
+def assert_no_upcast(name, inputs, outputs):
+  """
+  If check_dtypes is set, make sure that the op called name did not upcast:
+  no floating point output may be wider than the narrowest floating point
+  input. Non-floating inputs such as word indices and masks are ignored.
+
+  Inputs:
+  - name: Name of the op, used in the error message
+  - inputs: List of arrays given to the op
+  - outputs: List of arrays returned by the op
+  """
+  if not check_dtypes: return
+  in_dtypes = [np.asarray(a).dtype for a in inputs]
+  in_dtypes = [dt for dt in in_dtypes if dt.kind == 'f']
+  if len(in_dtypes) == 0: return
+  narrowest = min(in_dtypes, key=lambda dt: dt.itemsize)
+  for out in outputs:
+    dt = np.asarray(out).dtype
+    if dt.kind == 'f' and dt.itemsize > narrowest.itemsize:
+      raise TypeError('%s upcasts from %s to %s' % (name, narrowest, dt))
+
 
 def rnn_step_forward(x, prev_h, Wx, Wh, b):
   """
@@ -35,7 +65,8 @@ def rnn_step_forward(x, prev_h, Wx, Wh, b):
   next_h = np.tanh(prev_h.dot(Wh) + x.dot(Wx) + b) # yield NxH matrix
 
 
-  cache = (Wx, Wh, x, prev_h)
+  cache = (Wx, Wh, x, prev_h, next_h)
+  assert_no_upcast('rnn_step_forward', [x, prev_h, Wx, Wh, b], [next_h])
   pass
   ##############################################################################
   #                               END OF YOUR CODE                             #
@@ -67,8 +98,7 @@ def rnn_step_backward(dnext_h, cache):
   ##############################################################################
 
   # next_h is exactly the output of tanh (see above)
-  # TODO(aroetter): are all these used? next_h think not
-  (Wx, Wh, x, prev_h) = cache
+  (Wx, Wh, x, prev_h, next_h) = cache
 
   # derivative of tanh(x) => 1 - (tanh(x)^2)
   tanh_deriv = 1.0 - next_h**2
@@ -91,7 +121,8 @@ def rnn_step_backward(dnext_h, cache):
   dWx = x.T.dot(dArg)
   dWh = prev_h.T.dot(dArg)
   db = dArg.sum(axis=0)
-  
+  assert_no_upcast('rnn_step_backward', [dnext_h, Wx, Wh],
+                   [dx, dprev_h, dWx, dWh, db])
   pass
   ##############################################################################
   #                               END OF YOUR CODE                             #
@@ -122,17 +153,21 @@ def rnn_forward(x, h0, Wx, Wh, b):
   # input data. You should use the rnn_step_forward function that you defined  #
   # above.                                                                     #
   ##############################################################################
-  h, cache = None, []
   N, T, D = x.shape
   H = h0.shape[1]
-  
+
+  # The input-to-hidden projection does not depend on the recurrence, so we
+  # compute it for all timesteps with a single (N*T, D) x (D, H) matrix multiply
+  # and only run the hidden-to-hidden product inside the loop.
+  xWx = x.reshape(N * T, D).dot(Wx).reshape(N, T, H) + b
+
   next_h = h0
-  h = np.empty((N, T, H))
+  h = np.empty((N, T, H), dtype=xWx.dtype)
   for t in xrange(T):
-    curx = x[:,t,:] # has shape NxD
-    (next_h, cur_cache) = rnn_step_forward(curx, next_h, Wx, Wh, b)
+    next_h = np.tanh(next_h.dot(Wh) + xWx[:, t, :])
     h[:, t, :] = next_h # next_h is NxH
-    cache.append(cur_cache)
+  cache = (x, h0, Wx, Wh, h)
+  assert_no_upcast('rnn_forward', [x, h0, Wx, Wh, b], [h])
   pass
   ##############################################################################
   #                               END OF YOUR CODE                             #
@@ -160,30 +195,33 @@ def rnn_backward(dh, cache):
   # sequence of data. You should use the rnn_step_backward function that you   #
   # defined above.                                                             #
   ##############################################################################
+  x, h0, Wx, Wh, h = cache
   N, T, H = dh.shape
-  D = cache[0][1].shape[0]
-
-  dx = np.empty((N, T, D))
-  dprev_h = np.zeros((N, H))
-  dWx = np.zeros((D, H))
-  dWh = np.zeros((H, H))
-  db = np.zeros(H)
-  
+  D = x.shape[2]
+
+  # Only the recurrent part of the gradient has to be computed step by step;
+  # we collect dLoss/dArg for every timestep and then compute the gradients of
+  # the inputs and weights with one large matrix multiply each.
+  dtype = np.result_type(dh, Wh)
+  dArg = np.empty((N, T, H), dtype=dtype)
+  dprev_h = np.zeros((N, H), dtype=dtype)
   for t in reversed(xrange(T)):
-    cur_cache = cache[t]
     # at each step, the derivative is the derivative i get from later
-    # on in the computation (dh), as well as the derivative i got from
-    # rnn_step_backward (dprev_h), which corresponds to the derivative
-    # from future time steps
-    total_dh = dh[:, t, :] + dprev_h
-    (cur_dx, dprev_h, cur_dWx, cur_dWh, cur_db) = rnn_step_backward(
-      total_dh, cur_cache)
-    dx[:, t, :] = cur_dx
-    dWx += cur_dWx
-    dWh += cur_dWh
-    db += cur_db
+    # on in the computation (dh), as well as the derivative from future time
+    # steps (dprev_h); tanh'(arg) == 1 - next_h**2
+    dArg[:, t, :] = (dh[:, t, :] + dprev_h) * (1.0 - h[:, t, :]**2)
+    dprev_h = dArg[:, t, :].dot(Wh.T)
   # final hidden layer
   dh0 = dprev_h
+
+  # the hidden state fed into step t is h0 for t == 0 and h[:, t - 1] after
+  prev_h = np.concatenate((h0[:, None, :], h[:, :-1, :]), axis=1)
+  dArg_flat = dArg.reshape(N * T, H)
+  dx = dArg_flat.dot(Wx.T).reshape(N, T, D)
+  dWx = x.reshape(N * T, D).T.dot(dArg_flat)
+  dWh = prev_h.reshape(N * T, H).T.dot(dArg_flat)
+  db = dArg_flat.sum(axis=0)
+  assert_no_upcast('rnn_backward', [dh, Wx, Wh], [dx, dh0, dWx, dWh, db])
   pass
   ##############################################################################
   #                               END OF YOUR CODE                             #
@@ -215,18 +253,12 @@ def word_embedding_forward(x, W):
 
   # I'll i'm doing is a lookup. each string out of the N i have is made of
   # T words. All I do is lookup that word (an index 0 <= idx < V) and swap
-  # it for the corresponding D delement vector.
-
-  N, T = x.shape
-  D = W.shape[1]
-
-  out = np.empty((N, T, D))
-  for n in xrange(N):
-    cur_seq = x[n]
-    out[n, :, :] = W[cur_seq]
-  # TODO(aroetter: save the cache
+  # it for the corresponding D delement vector. A single gather does this for
+  # all N*T words at once.
+  out = np.take(W, x, axis=0)
   V = W.shape[0]
   cache = (x, V)
+  assert_no_upcast('word_embedding_forward', [W], [out])
   pass
   ##############################################################################
   #                               END OF YOUR CODE                             #
@@ -234,7 +266,7 @@ def word_embedding_forward(x, W):
   return out, cache
 
 
-def word_embedding_backward(dout, cache):
+def word_embedding_backward(dout, cache, sparse=False):
   """
   Backward pass for word embeddings. We cannot back-propagate into the words
   since they are integers, so we only return gradient for the word embedding
@@ -245,9 +277,15 @@ def word_embedding_backward(dout, cache):
   Inputs:
   - dout: Upstream gradients of shape (N, T, D)
   - cache: Values from the forward pass
+  - sparse: If True, return the gradient in row-sparse form; a minibatch
+    only touches a small part of the vocabulary, and all other rows of the
+    gradient are zero.
   
   Returns:
-  - dW: Gradient of word embedding matrix, of shape (V, D).
+  - dW: Gradient of word embedding matrix, of shape (V, D). If sparse is
+    True, dW is instead a tuple (ids, rows) where ids is a sorted array of
+    the K distinct words in the minibatch and rows, of shape (K, D), holds
+    the matching rows of the gradient.
   """
   dW = None
   ##############################################################################
@@ -258,23 +296,70 @@ def word_embedding_backward(dout, cache):
   x, V = cache
   N, T, D = dout.shape
 
-  dW = np.zeros((V, D))
-  for n in range(N):
-    indexes = x[n, :] # of shape T...there are T words in this datapt
-    gradients = dout[n, :, :] # of shape TxD.
-    # logically what this is doing is:
-    # loop over every word in the current datapt. (stored in indexes)
-    #   lookup the D gradients for that word
-    #   add those D gradients to the relevant row (for the cur word) in dW
-    # indexes is used to both slice into gradients (for reading), and into dW
-    #   (for incrementing)
-    np.add.at(dW, indexes, gradients)
+  # Instead of np.add.at, sort the N*T words so that equal words are next to
+  # each other, and sum the gradients of each run of equal words with a
+  # single reduceat.
+  words = x.ravel()
+  order = np.argsort(words, kind='mergesort')
+  sorted_words = words[order]
+  starts = np.flatnonzero(np.r_[True, sorted_words[1:] != sorted_words[:-1]])
+  ids = sorted_words[starts]
+  rows = np.add.reduceat(dout.reshape(N * T, D)[order], starts, axis=0)
+
+  if sparse:
+    assert_no_upcast('word_embedding_backward', [dout], [rows])
+    return ids, rows
+
+  dW = np.zeros((V, D), dtype=dout.dtype)
+  dW[ids] = rows
+  assert_no_upcast('word_embedding_backward', [dout], [dW])
   ##############################################################################
   #                               END OF YOUR CODE                             #
   ##############################################################################
   return dW
 
 
+def add_sparse_rows(a, b):
+  """
+  Add two row-sparse gradients as returned by word_embedding_backward with
+  sparse=True.
+
+  Inputs:
+  - a, b: Tuples (ids, rows) of sorted distinct row ids and matching rows, or
+    (ids, rows, axis) for gradients that are sparse along another axis; see
+    scatter_sparse_rows.
+
+  Returns:
+  - The sum, in the same form as a and b
+  """
+  ids, inverse = np.unique(np.concatenate([a[0], b[0]]), return_inverse=True)
+  rows = np.zeros((ids.shape[0],) + a[1].shape[1:],
+                  dtype=np.result_type(a[1], b[1]))
+  rows[inverse[:a[0].shape[0]]] += a[1]
+  rows[inverse[a[0].shape[0]:]] += b[1]
+  return (ids, rows) + tuple(a[2:])
+
+
+def scatter_sparse_rows(grad, out):
+  """
+  Write a row-sparse gradient into the dense array out, zeroing everything
+  else.
+
+  Inputs:
+  - grad: Tuple (ids, rows), where rows[i] is the gradient of out[ids[i]], or
+    (ids, rows, axis) for a gradient that is sparse along the given axis,
+    where rows[i] is the gradient of out.take(ids[i], axis).
+  - out: Dense array to write to
+
+  Returns:
+  - out
+  """
+  out[...] = 0
+  axis = grad[2] if len(grad) > 2 else 0
+  np.rollaxis(out, axis)[grad[0]] = grad[1]
+  return out
+
+
 def sigmoid(x):
   """
   A numerically stable version of the logistic sigmoid function.
@@ -289,6 +374,114 @@ def sigmoid(x):
   return top / (1 + z)
 
 
+def _lstm_gates_forward(a, prev_c, next_c=None, next_h=None):
+  """
+  Fused LSTM gate kernel for a single timestep. The nonlinearities are applied
+  in place to the pre-activations, so after this call a holds the gate
+  activations [i, f, o, g]; no temporary arrays are allocated.
+
+  Inputs:
+  - a: Gate pre-activations, of shape (N, 4H), laid out as [i, f, o, g]
+  - prev_c: Previous cell state, of shape (N, H)
+  - next_c, next_h: Optional arrays of shape (N, H) to write the outputs into
+
+  Returns a tuple of:
+  - next_c: Next cell state, of shape (N, H)
+  - next_h: Next hidden state, of shape (N, H)
+  """
+  H = prev_c.shape[1]
+  if next_c is None: next_c = np.empty_like(prev_c)
+  if next_h is None: next_h = np.empty_like(prev_c)
+
+  # sigmoid(x) == 0.5 * (1 + tanh(x / 2)); this is numerically stable for
+  # large |x| and, unlike the masked version above, can be evaluated in place.
+  ifo = a[:, :3 * H]
+  ifo *= 0.5
+  np.tanh(ifo, out=ifo)
+  ifo += 1
+  ifo *= 0.5
+  np.tanh(a[:, 3 * H:], out=a[:, 3 * H:])
+
+  # each is NxH; np.split returns views into a
+  (i, f, o, g) = np.split(a, 4, axis=1)
+
+  # next_c = f * prev_c + i * g, using next_h as scratch space
+  np.multiply(f, prev_c, out=next_c)
+  np.multiply(i, g, out=next_h)
+  next_c += next_h
+  # next_h = o * tanh(next_c)
+  np.tanh(next_c, out=next_h)
+  next_h *= o
+  return next_c, next_h
+
+
+def _lstm_gates_backward(dnext_h, dnext_c, gates, next_c, prev_c, da,
+                         dprev_c=None):
+  """
+  Fused backward kernel for the LSTM nonlinearities of a single timestep. The
+  gradients of the gate pre-activations are written straight into da.
+
+  Inputs:
+  - dnext_h: Gradients of next hidden state, of shape (N, H)
+  - dnext_c: Gradients of next cell state, of shape (N, H)
+  - gates: Gate activations from _lstm_gates_forward, of shape (N, 4H)
+  - next_c, prev_c: Cell states from the forward pass, of shape (N, H)
+  - da: Array of shape (N, 4H) that receives the gradient of the gate
+    pre-activations
+  - dprev_c: Optional array of shape (N, H) to write the gradient of the
+    previous cell state into; this may be the same array as dnext_c.
+
+  Returns:
+  - dprev_c: Gradient of previous cell state, of shape (N, H)
+  """
+  if dprev_c is None: dprev_c = np.empty_like(dnext_c)
+  tmp = np.empty_like(dnext_c)
+  (i, f, o, g) = np.split(gates, 4, axis=1)
+  (da_i, da_f, da_o, da_g) = np.split(da, 4, axis=1)
+
+  # da_o holds tanh(next_c) until we get to the output gate below
+  tanh_next_c = da_o
+  np.tanh(next_c, out=tanh_next_c)
+
+  # The total gradient of next_c combines the direct path (dnext_c) with the
+  # path through next_h = o * tanh(next_c):
+  # dc = dnext_c + dnext_h * o * (1 - tanh(next_c)^2)
+  dc = dprev_c
+  np.multiply(tanh_next_c, tanh_next_c, out=tmp)
+  np.subtract(1, tmp, out=tmp)
+  tmp *= o
+  tmp *= dnext_h
+  np.add(dnext_c, tmp, out=dc)
+
+  # dLoss/da_o = dnext_h * tanh(next_c) * o * (1 - o)
+  da_o *= dnext_h
+  np.subtract(1, o, out=tmp)
+  tmp *= o
+  da_o *= tmp
+
+  # dLoss/da_i = dc * g * i * (1 - i)
+  np.multiply(dc, g, out=da_i)
+  np.subtract(1, i, out=tmp)
+  tmp *= i
+  da_i *= tmp
+
+  # dLoss/da_f = dc * prev_c * f * (1 - f)
+  np.multiply(dc, prev_c, out=da_f)
+  np.subtract(1, f, out=tmp)
+  tmp *= f
+  da_f *= tmp
+
+  # dLoss/da_g = dc * i * (1 - g^2)
+  np.multiply(g, g, out=da_g)
+  np.subtract(1, da_g, out=da_g)
+  da_g *= i
+  da_g *= dc
+
+  # dLoss/dprev_c = dc * f
+  dc *= f
+  return dprev_c
+
+
 def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
   """
   Forward pass for a single timestep of an LSTM.
@@ -314,22 +507,19 @@ def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
   # TODO: Implement the forward pass for a single timestep of an LSTM.        #
   # You may want to use the numerically stable sigmoid implementation above.  #
   #############################################################################
-  H = prev_h.shape[1]
-  a = x.dot(Wx) + prev_h.dot(Wh) + b # a is of shape Nx4H
-
-  # each is NxH
-  (a_i, a_f, a_o, a_g) = np.split(a, 4, axis=1)
-  i, f, o  = sigmoid(a_i), sigmoid(a_f), sigmoid(a_o)
-  g = np.tanh(a_g)
-
-  next_c = f * prev_c + i * g
-  next_h = o * np.tanh(next_c)
+  # a is of shape Nx4H; it is the only workspace we need for the gates
+  a = x.dot(Wx)
+  a += prev_h.dot(Wh)
+  a += b
+  next_c, next_h = _lstm_gates_forward(a, prev_c)
   
   ##############################################################################
   #                               END OF YOUR CODE                             #
   ##############################################################################
 
-  cache = (i, f, o, g, next_c, prev_c, prev_h, Wx, Wh, x)
+  cache = (a, next_c, prev_c, prev_h, Wx, Wh, x)
+  assert_no_upcast('lstm_step_forward', [x, prev_h, prev_c, Wx, Wh, b],
+                   [next_h, next_c])
   
   return next_h, next_c, cache
 
@@ -358,55 +548,10 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
   # HINT: For sigmoid and tanh you can compute local derivatives in terms of  #
   # the output value from the nonlinearity.                                   #
   #############################################################################
-  (i, f, o, g, next_c, prev_c, prev_h, Wx, Wh, x) = cache
-
-  tanh_next_c = np.tanh(next_c)
-
-  # one thing we'll need over and over is the derivative of loss wrt
-  # dnext_c, VIA the next_h equation.
-  # dLoss/dnext_c = dloss/dnext_h * dnext_h/dnext_c
-  alt_dnext_c = dnext_h * o * (1-np.power(tanh_next_c, 2))
-  
-  # many of this gradients contribute in 2 ways, once via next_c, once
-  # via next_h. here we call those paths 1 and 2, just for clarity.
-
-  # Path 1 (via next_c). dloss/dprev_c = dloss/dnext_c * dnext_c/dprev_c
-  dprev_c = dnext_c * f
-  # Path 2 (via next_h). dloss/dprev_c = alt_dnext_c * dnext_c/d_prevc
-  dprev_c += alt_dnext_c * f
-
-  # compute do. only contributes via path 2, via next_h
-  # Path 2 (via H): dLoss/do = dLoss/dnext_h * dnext_h / do
-  do = dnext_h * tanh_next_c
-
-  # compute df
-  # Path 1 (via next_c): dLoss/df = dLoss/dnext_c * dnext_c/df
-  df = dnext_c * prev_c
-  # Path 2 (via next_h): dLoss/dh = alt_dnext_c * dnext_c/df
-  df += alt_dnext_c * prev_c
-  
-  # compute di
-  # Path 1 (via next_c): dLoss/di = dLoss/dnext_c * dnext_c/di
-  di = dnext_c * g
-  # Path 2 (via next_h): dLoss/di = alt_dnext_c * dnext_c/di
-  di += alt_dnext_c * g
-
-  # compute dg
-  # Path 1 (via_next_c): dLoss/dg = dLoss/dnext_c * dnext_c/dg
-  # Path 2 (via next_h): dLoss/dg = alt_dnext_c * dnext_c/dg
-  dg = dnext_c * i
-  dg += alt_dnext_c * i
-
-  # now backprop through the sigmoids and tanh to get the a_*'s
-  # dLoss/da_i = dLoss/di * di/da_i (remember sigmoid(a_i) == i)
-  da_i = di * i * (1-i)
-  da_f = df * f * (1-f)
-  da_o = do * o * (1-o)
-  # dLoss/da_g = dLoss/dg * dg/da_g (remember g = tanh(a_g))
-  da_g = dg * (1-np.power(g, 2))
-
-  # remember a is just the concatenation of a_i, a_f, a_o, a_g
-  da = np.hstack((da_i, da_f, da_o, da_g))
+  (gates, next_c, prev_c, prev_h, Wx, Wh, x) = cache
+
+  da = np.empty_like(gates)
+  dprev_c = _lstm_gates_backward(dnext_h, dnext_c, gates, next_c, prev_c, da)
 
   # Now using da we can compute a bunch of results
   # dLoss/dx = dLoss/da * da/dx
@@ -423,6 +568,8 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
 
   # dLoss/db = dLoss/da * da/db
   db = da.sum(axis=0) 
+  assert_no_upcast('lstm_step_backward', [dnext_h, dnext_c, Wx, Wh],
+                   [dx, dprev_h, dprev_c, dWx, dWh, db])
   ##############################################################################
   #                               END OF YOUR CODE                             #
   ##############################################################################
@@ -430,16 +577,67 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
   return dx, dprev_h, dprev_c, dWx, dWh, db
 
 
-def lstm_forward(x, h0, Wx, Wh, b):
+class LSTMCache(object):
+  """
+  Values stored by lstm_forward for use in lstm_backward. Instead of a list of
+  per-timestep tuples we keep a handful of preallocated time-major buffers, so
+  the forward pass writes every timestep in place and the backward pass works
+  on contiguous slabs.
+
+  Attributes:
+  - x: Input data in time-major order, of shape (T, N, D)
+  - Wx, Wh: Weights used for the forward pass
+  - gates: Gate activations [i, f, o, g] for all timesteps, of shape (T, N, 4H)
+  - h: Hidden states, of shape (T + 1, N, H); h[0] is the initial hidden state
+  - c: Cell states, of shape (T + 1, N, H); c[0] is the initial cell state
+  - active: For packed sequences, an integer array of shape (T,) giving the
+    number of rows that are still running at each timestep; otherwise None.
+  - valid: For packed sequences, a boolean array of shape (T, N) telling which
+    entries of the buffers were computed; otherwise None.
+  """
+  __slots__ = ('x', 'Wx', 'Wh', 'gates', 'h', 'c', 'active', 'valid')
+
+  def __init__(self, x, Wx, Wh, gates, h, c, active=None, valid=None):
+    self.x, self.Wx, self.Wh = x, Wx, Wh
+    self.gates, self.h, self.c = gates, h, c
+    self.active, self.valid = active, valid
+
+
+def _packed_timesteps(lengths, T):
+  """
+  Helper for packed sequences. Given the lengths of the sequences of a
+  minibatch, sorted from longest to shortest, compute how many rows are active
+  at every timestep and a (T, N) boolean mask of the active entries. Returns
+  (None, None) if lengths is None.
+  """
+  if lengths is None:
+    return None, None
+  lengths = np.asarray(lengths)
+  if np.any(np.diff(lengths) > 0):
+    raise ValueError('lengths must be sorted in non-increasing order')
+  valid = np.arange(T)[:, None] < lengths[None, :]
+  active = valid.sum(axis=1)
+  return active, valid
+
+
+def lstm_forward(x, h0, Wx, Wh, b, c0=None, lengths=None):
   """
   Forward pass for an LSTM over an entire sequence of data. We assume an input
   sequence composed of T vectors, each of dimension D. The LSTM uses a hidden
   size of H, and we work over a minibatch containing N sequences. After running
   the LSTM forward, we return the hidden states for all timesteps.
   
-  Note that the initial cell state is passed as input, but the initial cell
-  state is set to zero. Also note that the cell state is not returned; it is
-  an internal variable to the LSTM and is not accessed from outside.
+  Note that the initial hidden state is passed as input, but the initial cell
+  state is set to zero unless c0 is given (for example to carry the state
+  across chunks of a long sequence). Also note that the cell state is not
+  returned; it is an internal variable to the LSTM, and the final cell state
+  can be read from cache.c[-1] if needed.
+
+  If lengths is given, the minibatch is treated as packed sequences of
+  different lengths, sorted from longest to shortest. Row n is only run for
+  its first lengths[n] timesteps, so the active batch shrinks as sequences end
+  and padded timesteps cost no computation; after a sequence has ended its
+  hidden and cell state are simply carried forward.
   
   Inputs:
   - x: Input data of shape (N, T, D)
@@ -447,10 +645,14 @@ def lstm_forward(x, h0, Wx, Wh, b):
   - Wx: Weights for input-to-hidden connections, of shape (D, 4H)
   - Wh: Weights for hidden-to-hidden connections, of shape (H, 4H)
   - b: Biases of shape (4H,)
+  - c0: Optional initial cell state of shape (N, H)
+  - lengths: Optional integer array of shape (N,) giving the length of each
+    sequence, in non-increasing order.
   
   Returns a tuple of:
-  - h: Hidden states for all timesteps of all sequences, of shape (N, T, H)
-  - cache: Values needed for the backward pass.
+  - h: Hidden states for all timesteps of all sequences, of shape (N, T, H).
+    This is a view into the cache, so it should not be modified in place.
+  - cache: LSTMCache holding the values needed for the backward pass.
   """
   #############################################################################
   # TODO: Implement the forward pass for an LSTM over an entire timeseries.   #
@@ -458,17 +660,42 @@ def lstm_forward(x, h0, Wx, Wh, b):
   #############################################################################
   N, T, D = x.shape
   H = h0.shape[1]
-  h = np.empty((N, T, H))
-  cache = []
-  
-  next_c = np.zeros((N, H))
-  next_h = h0
+  active, valid = _packed_timesteps(lengths, T)
+
+  # Project the inputs of all timesteps with one large matrix multiply; only
+  # the recurrent hidden-to-hidden product has to stay inside the loop. The
+  # result is the gates buffer, which is overwritten in place with the
+  # activations of each timestep. For packed sequences we only project the
+  # (timestep, row) pairs that are actually run.
+  xt = np.ascontiguousarray(x.transpose(1, 0, 2))
+  if valid is None:
+    gates = xt.reshape(T * N, D).dot(Wx).reshape(T, N, 4 * H)
+    gates += b
+  else:
+    xWx = xt[valid].dot(Wx)
+    xWx += b
+    gates = np.empty((T, N, 4 * H), dtype=xWx.dtype)
+    gates[valid] = xWx
+
+  # All intermediate values live in preallocated time-major buffers, so every
+  # timestep reads and writes one contiguous (N, .) slab and the size of the
+  # cache is known up front.
+  hs = np.empty((T + 1, N, H), dtype=gates.dtype)
+  cs = np.empty((T + 1, N, H), dtype=gates.dtype)
+  hs[0] = h0
+  cs[0] = 0 if c0 is None else c0
+
   for t in xrange(T):
-    curx = x[:,t,:] # has shape NxD
-    (next_h, next_c, cur_cache) = lstm_step_forward(
-      curx, next_h, next_c, Wx, Wh, b)
-    h[:, t, :] = next_h
-    cache.append(cur_cache)
+    n = N if active is None else active[t]
+    a = gates[t, :n]
+    a += hs[t, :n].dot(Wh)
+    _lstm_gates_forward(a, cs[t, :n], cs[t + 1, :n], hs[t + 1, :n])
+    if n < N:
+      hs[t + 1, n:] = hs[t, n:]
+      cs[t + 1, n:] = cs[t, n:]
+  h = hs[1:].transpose(1, 0, 2)
+  cache = LSTMCache(xt, Wx, Wh, gates, hs, cs, active, valid)
+  assert_no_upcast('lstm_forward', [x, h0, Wx, Wh, b], [h])
   pass
   ##############################################################################
   #                               END OF YOUR CODE                             #
@@ -483,7 +710,7 @@ def lstm_backward(dh, cache):
   
   Inputs:
   - dh: Upstream gradients of hidden states, of shape (N, T, H)
-  - cache: Values from the forward pass
+  - cache: LSTMCache from the forward pass
   
   Returns a tuple of:
   - dx: Gradient of input data of shape (N, T, D)
@@ -498,26 +725,46 @@ def lstm_backward(dh, cache):
   # You should use the lstm_step_backward function that you just defined.     #
   #############################################################################
   N, T, H = dh.shape
-  D = cache[0][9].shape[1] #get an 'x' array from the cache. 2nd dim is D
+  Wx, Wh = cache.Wx, cache.Wh
+  D = cache.x.shape[2]
 
-  dx = np.empty((N, T, D))
-  dprev_h = np.zeros((N, H))
-  dprev_c = np.zeros((N, H))
-  dWx = np.zeros((D, 4*H))
-  dWh = np.zeros((H, 4*H))
-  db = np.zeros(4*H)
+  # Only the recurrence has to be walked step by step. We collect the gradient
+  # of the gate pre-activations for every timestep and then compute the
+  # gradients of the inputs and weights with one large matrix multiply each.
+  dtype = np.result_type(dh, Wh)
+  da = np.empty((T, N, 4 * H), dtype=dtype)
+  dprev_h = np.zeros((N, H), dtype=dtype)
+  dprev_c = np.zeros((N, H), dtype=dtype)
 
   for t in reversed(xrange(T)):
-    cur_cache = cache[t]
-    total_dh = dh[:, t, :] + dprev_h
-    (cur_dx, dprev_h, dprev_c, cur_dWx, cur_dWh, cur_db) = lstm_step_backward(
-      total_dh, dprev_c, cur_cache)
-    dx[:, t, :] = cur_dx
-    dWx += cur_dWx
-    dWh += cur_dWh
-    db += cur_db
+    # dprev_h becomes the total gradient of this step's hidden state, and the
+    # gate kernel updates dprev_c in place. Rows of packed sequences that have
+    # already ended just pass their gradients through to the previous step.
+    n = N if cache.active is None else cache.active[t]
+    dprev_h += dh[:, t, :]
+    _lstm_gates_backward(dprev_h[:n], dprev_c[:n], cache.gates[t, :n],
+                         cache.c[t + 1, :n], cache.c[t, :n], da[t, :n],
+                         dprev_c[:n])
+    np.dot(da[t, :n], Wh.T, out=dprev_h[:n])
   # final hidden layer
   dh0 = dprev_h
+
+  if cache.valid is None:
+    da_flat = da.reshape(T * N, 4 * H)
+    dx = da_flat.dot(Wx.T).reshape(T, N, D).transpose(1, 0, 2)
+    dWx = cache.x.reshape(T * N, D).T.dot(da_flat)
+    dWh = cache.h[:-1].reshape(T * N, H).T.dot(da_flat)
+    db = da_flat.sum(axis=0)
+  else:
+    valid = cache.valid
+    da_packed = da[valid]
+    dxt = np.zeros((T, N, D), dtype=dtype)
+    dxt[valid] = da_packed.dot(Wx.T)
+    dx = dxt.transpose(1, 0, 2)
+    dWx = cache.x[valid].T.dot(da_packed)
+    dWh = cache.h[:-1][valid].T.dot(da_packed)
+    db = da_packed.sum(axis=0)
+  assert_no_upcast('lstm_backward', [dh, Wx, Wh], [dx, dh0, dWx, dWh, db])
   ##############################################################################
   #                               END OF YOUR CODE                             #
   ##############################################################################
@@ -545,6 +792,7 @@ def temporal_affine_forward(x, w, b):
   M = b.shape[0]
   out = x.reshape(N * T, D).dot(w).reshape(N, T, M) + b
   cache = x, w, b, out
+  assert_no_upcast('temporal_affine_forward', [x, w, b], [out])
   return out, cache
 
 
@@ -568,6 +816,7 @@ def temporal_affine_backward(dout, cache):
   dx = dout.reshape(N * T, M).dot(w.T).reshape(N, T, D)
   dw = dout.reshape(N * T, M).T.dot(x.reshape(N * T, D)).T
   db = dout.sum(axis=(0, 1))
+  assert_no_upcast('temporal_affine_backward', [dout, x, w], [dx, dw, db])
 
   return dx, dw, db
 
@@ -616,6 +865,7 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
   if verbose: print 'dx_flat: ', dx_flat.shape
   
   dx = dx_flat.reshape(N, T, V)
+  assert_no_upcast('temporal_softmax_loss', [x], [dx])
   
   return loss, dx
 
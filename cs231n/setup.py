@@ -3,9 +3,13 @@ from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# The im2col kernels are parallelized with OpenMP; build with a compiler that
+# supports -fopenmp (gcc does; on OS X use gcc from Homebrew).
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = ['-fopenmp'],
+            extra_link_args = ['-fopenmp'],
   ),
 ]
 